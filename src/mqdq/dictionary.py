@@ -5,7 +5,9 @@ scanned mqdq texts.
 """
 
 from pathlib import Path
+from multiprocessing import Pool
 import argparse
+import hashlib
 import sys
 from collections import defaultdict
 from tqdm import tqdm
@@ -27,6 +29,8 @@ class MqDqDictionary:
                     "ȳ́": "y_", "ý": "y*", "ȳ": "y_", "y̆": "y^",
                     "œ": "[oe]", "œ̄́": "[oe]", "œ́": "[oe]", "œ̄": "[oe]", "œ̆": "[oe]",
                     "æ": "[ae]", "ǣ́": "[ae]", "ǽ": "[ae]", "ǣ": "[ae]", "æ̆": "[ae]"}
+    NORMALIZER = Normalizer(REPLACEMENTS)
+    MANIFEST = "manifest.json"  # the list of authors in a shard directory, see augment()
 
     # to catch unexpected characters
     UNEXPECTED = re.compile("[^a-z\^_‿⁔*\[\]<>\n†(\-\") –\"\t&.?!;:0-9,’“‘\"\\xc2\\xa0\\\]")
@@ -40,6 +44,12 @@ class MqDqDictionary:
     PREFIX = re.compile("^[" + DOUBLE_CONSONANTS + CONSONANTS + "]*")
     ERROR = re.compile("(?<!\[)[oyea](?![*_^\]])")  # no quantity specified
     U_ERROR = re.compile("[*_\^]u([" + VOWELS + "]|$)")  # does not work wel with novum
+    CONSONANT_U = re.compile("u([^\]\^*_])")
+    CONSONANT_I = re.compile("i([^\]\^*_])")
+    DIPHTHONG_E = re.compile("(\[ae\]|\[oe\])")
+    NON_ALPHABETIC = re.compile("[^a-z]")
+    QUANTITY_MARKS = re.compile("[\^_*\[\]\n\t]")
+    SPACES = re.compile(" +")
 
     def __init__(self):
         self.data = defaultdict(dict)
@@ -58,7 +68,16 @@ class MqDqDictionary:
         :param file:
         :return:
         """
-        json.dump(self.data, file, indent=2)
+        data = self.data.to_dict() if isinstance(self.data, CompactLexicon) else self.data
+        json.dump(data, file, indent=2)
+
+    def compact(self):
+        """
+        Convert the dictionary into a CompactLexicon, which takes much less memory. Words can no
+        longer be added to the dictionary after that
+        :return: None
+        """
+        self.data = CompactLexicon(self.data)
 
     def look_up(self, form):
         """
@@ -66,9 +85,40 @@ class MqDqDictionary:
         :param form:
         :return:
         """
-        key = re.sub("[^a-z]", "", form.lower())
-        key = multireplace(key, {"v": "u", "j": "i"})
-        return self.data.get(key, {})
+        return self.data.get(MqDqDictionary.get_key(form), {})
+
+    def look_up_stats(self, form):
+        """
+        Look up the number of times every scansion of a form occurs in the dictionary and the
+        number of authors that use it. These are precomputed if the dictionary is compact
+        :param form:
+        :return:    a list of (scansion, total count, number of authors) tuples
+        """
+        key = MqDqDictionary.get_key(form)
+        if isinstance(self.data, CompactLexicon):
+            return self.data.get_stats(key)
+        return [(scansion, sum(authors.values()), len(authors))
+                for scansion, authors in self.data.get(key, {}).items()]
+
+    def select_authors(self, weights):
+        """
+        Restrict all the subsequent look-ups to a subset of authors, optionally weighting their
+        counts. The dictionary is converted into a CompactLexicon, if it is not one already
+        :param weights: a dictionary {author: weight} or None to use all authors
+        :return:        None
+        """
+        if not isinstance(self.data, CompactLexicon):
+            self.compact()
+        self.data.select_authors(weights)
+
+    @staticmethod
+    def get_key(form):
+        """
+        Return the key under which a form is stored in the dictionary
+        :param form:
+        :return:    a string
+        """
+        return KEY_NORMALIZER(MqDqDictionary.NON_ALPHABETIC.sub("", form.lower()))
 
     def add_word(self, word, next_word, author, diphthongs):
         """
@@ -94,13 +144,12 @@ class MqDqDictionary:
         if len(word) > 4 and word[-4:] in ["que^", "que*", "qve^", "qve*"]:
             self.add_word(word[:-4], "qv", author, diphthongs)
             return
-        word = re.sub("u([^\]\^*_])", r"v\1", word)
-        word = re.sub("i([^\]\^*_])", r"j\1", word)
+        word = MqDqDictionary.CONSONANT_U.sub(r"v\1", word)
+        word = MqDqDictionary.CONSONANT_I.sub(r"j\1", word)
         if not diphthongs:
-            word = re.sub("(\[ae\]|\[oe\])", "e_", word)
+            word = MqDqDictionary.DIPHTHONG_E.sub("e_", word)
 
-        key = re.sub("[^a-z]", "", word.lower())
-        key = multireplace(key, {"v": "u", "j": "i"})
+        key = MqDqDictionary.get_key(word)
         if word not in self.data[key]:
             self.data[key][word] = defaultdict(int)
         self.data[key][word][author] += 1
@@ -113,13 +162,14 @@ class MqDqDictionary:
         :param diphthongs: if True, replace [ae] and [oe] with e
         :return:
         """
-        verse = re.sub("[\^_*\[\]\n\t]", "", verse)
-        verse = multireplace(verse.lower(), MqDqDictionary.REPLACEMENTS)
+        verse = MqDqDictionary.QUANTITY_MARKS.sub("", verse)
+        verse = MqDqDictionary.NORMALIZER(verse.lower())
         if list(MqDqDictionary.UNEXPECTED.finditer(verse)):
             # warnings.warn("An unexpected character found: " + verse)
             return
         verse = MqDqDictionary.UNUSED.sub("", verse)
-        verse = re.sub(" +", " ", verse).rstrip(" ").lstrip(" ")  # removing extra spaces
+        # removing extra spaces:
+        verse = MqDqDictionary.SPACES.sub(" ", verse).rstrip(" ").lstrip(" ")
         if len(verse) == 0:
             return
         words = verse.split(" ")
@@ -127,13 +177,35 @@ class MqDqDictionary:
         for i, word in enumerate(words[:-1]):
             self.add_word(word, words[i+1], author, diphthongs)
 
-    def augment(self, dir, authors, diphthongs):
+    def merge(self, data):
+        """
+        Add the counts from another dictionary to this one. Merging the dictionaries built from
+        several sets of texts in the order the texts come in gives exactly the same result as
+        building one dictionary from all of them
+        :param data:    the data attribute of another MqDqDictionary object
+        :return:        None
+        """
+        for key, entry in data.items():
+            for word, authors in entry.items():
+                if word not in self.data[key]:
+                    self.data[key][word] = defaultdict(int)
+                for author, count in authors.items():
+                    self.data[key][word][author] += count
+
+    def augment(self, dir, authors, diphthongs, jobs=1, shard_dir=None):
         """
         Augment the dictionary with scansions of all the texts written by the specified set of
         authors
         :param dir:     the directory with the scansions (where scraping.py downloads them to)
         :param authors: list of authors. If authors == [], all authors will be considered
         :param diphthongs: if True, replace [ae] and [oe] with e
+        :param jobs:    number of processes to use. If it is more than one, every text is
+                        processed into a separate dictionary and these are then merged
+        :param shard_dir: if specified, a separate dictionary (shard) is kept in this directory
+                        for every author along with a checksum of the author's texts. Only the
+                        shards of the authors whose texts have changed are rebuilt. The list
+                        of authors is saved in a manifest file, and only their shards are
+                        merged when the directory is loaded. Shards of other authors are kept
         :return:        None
         """
         authors_list = [str(x).split("/")[-1] for x in list(Path(dir).glob("*"))]
@@ -141,13 +213,132 @@ class MqDqDictionary:
         assert sum([x in authors_list for x in authors]) == len(authors)
         if not authors:
             authors = authors_list
-        for author in tqdm(authors):  # for any author
-            files = list(Path(dir.rstrip("/")+"/"+author).rglob("*.scanned"))
-            for file in files:  # for any text of that author that can be scanned
-                with open(file, "r", encoding="utf-8") as f:
-                    verses = f.readlines()
-                for verse in verses:  # for any line in that text
-                    self.add_verse(verse, author, diphthongs)  # add the word scansions to the dictionary
+        texts = [(file, author, diphthongs) for author in authors
+                 for file in Path(dir.rstrip("/")+"/"+author).rglob("*.scanned")]
+        if shard_dir is None:
+            for data in MqDqDictionary.__process_texts(texts, jobs):
+                self.merge(data)
+            return
+        Path(shard_dir).mkdir(parents=True, exist_ok=True)
+        shards, checksums = {}, {}
+        for author in authors:
+            files = [x[0] for x in texts if x[1] == author]
+            checksums[author] = MqDqDictionary.get_checksum(files, diphthongs)
+            shards[author] = MqDqDictionary.load_shard(shard_dir, author, checksums[author])
+        outdated = [author for author in authors if shards[author] is None]
+        print("Rebuilding {} out of {} author shards...".format(len(outdated), len(authors)))
+        for author in outdated:
+            shards[author] = MqDqDictionary()
+        texts = [x for x in texts if x[1] in outdated]
+        for text, data in zip(texts, MqDqDictionary.__process_texts(texts, jobs)):
+            shards[text[1]].merge(data)
+        for author in outdated:
+            shards[author].save_shard(shard_dir, author, checksums[author])
+        with open(Path(shard_dir) / MqDqDictionary.MANIFEST, "w") as file:
+            json.dump({"authors": authors}, file)
+        for author in authors:
+            self.merge(shards[author].data)
+
+    @staticmethod
+    def __process_texts(texts, jobs):
+        """
+        Build a separate dictionary from every text
+        :param texts:   a list of (filename, author, diphthongs) tuples
+        :param jobs:    number of processes to use
+        :return:        a generator that yields the data attributes of the dictionaries in the
+                        order the texts are given in
+        """
+        if jobs <= 1:
+            yield from tqdm(map(build_partial_dictionary, texts), total=len(texts))
+            return
+        with Pool(jobs) as pool:
+            yield from tqdm(pool.imap(build_partial_dictionary, texts), total=len(texts))
+
+    @staticmethod
+    def get_checksum(files, diphthongs):
+        """
+        Compute a checksum of a set of texts. A shard has to be rebuilt whenever this changes
+        :param files:       a list of names of the .scanned files
+        :param diphthongs:  the setting the shard is built with
+        :return:            a string
+        """
+        digest = hashlib.sha1(str(diphthongs).encode("utf-8"))
+        for file in files:
+            digest.update(str(file).encode("utf-8"))
+            with open(file, "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def save_shard(self, shard_dir, author, checksum):
+        """
+        Save the dictionary as the shard of a given author
+        :param shard_dir:   the directory with the shards
+        :param author:      the author the dictionary is built from
+        :param checksum:    the checksum of the texts the dictionary is built from
+        :return:            None
+        """
+        with open(Path(shard_dir) / (author + ".json"), "w") as file:
+            json.dump({"checksum": checksum, "data": self.data}, file)
+
+    @staticmethod
+    def load_shard(shard_dir, author, checksum):
+        """
+        Load the shard of a given author
+        :param shard_dir:   the directory with the shards
+        :param author:      the author whose shard to load
+        :param checksum:    the checksum of the author's texts
+        :return:            an MqDqDictionary object or None if there is no shard or if it was
+                            built from different texts
+        """
+        filename = Path(shard_dir) / (author + ".json")
+        if not filename.exists():
+            return None
+        with open(filename, "r") as file:
+            shard = json.load(file)
+        if shard["checksum"] != checksum:
+            return None
+        dictionary = MqDqDictionary()
+        dictionary.data = shard["data"]
+        return dictionary
+
+    def load_shards(self, shard_dir):
+        """
+        Load the dictionary by merging the shards listed in the manifest of a directory in the
+        order they are listed in, which is the order augment() merges them in (see augment)
+        :param shard_dir:   the directory with the shards
+        :return:            None
+        """
+        for filename in MqDqDictionary.get_shard_files(shard_dir)[1:]:
+            with open(filename, "r") as file:
+                self.merge(json.load(file)["data"])
+
+    @staticmethod
+    def get_shard_files(shard_dir):
+        """
+        List the files a dictionary is loaded from when it is loaded from shards
+        :param shard_dir:   the directory with the shards
+        :return:            a list of filenames: the manifest followed by the shards in the order
+                            they are merged in
+        """
+        manifest = Path(shard_dir) / MqDqDictionary.MANIFEST
+        with open(manifest, "r") as file:
+            authors = json.load(file)["authors"]
+        return [str(manifest)] + [str(Path(shard_dir) / (author + ".json")) for author in authors]
+
+
+def build_partial_dictionary(text):
+    """
+    Build a dictionary from a single text. This is run by the worker processes in
+    MqDqDictionary.augment()
+    :param text:    a (filename, author, diphthongs) tuple
+    :return:        the data attribute of the resulting MqDqDictionary object
+    """
+    filename, author, diphthongs = text
+    dictionary = MqDqDictionary()
+    with open(filename, "r", encoding="utf-8") as f:
+        for verse in f.readlines():
+            dictionary.add_verse(verse, author, diphthongs)
+    return dictionary.data
 
 
 if __name__ == "__main__":
@@ -162,9 +353,16 @@ if __name__ == "__main__":
                         "blank to include all authors")
     p.add_argument("--no_diphthongs", dest="diphthongs", action="store_false",
                    help="use to build a dictionary where 'ae' and 'oe' is replaced with 'e'")
+    p.add_argument("-jobs", type=int, default=1,
+                   help="number of processes to build the dictionary with")
+    p.add_argument("-shards", type=str, default=None,
+                   help="directory in which to keep a separate dictionary for every author. When "
+                        "the dictionary is rebuilt, only the authors whose texts have changed are "
+                        "processed again. The directory can also be passed to scan.py instead of "
+                        "the dictionary file")
     p.set_defaults(diphthongs=True)
     args = p.parse_args(sys.argv[1:])
 
     dictionary = MqDqDictionary()
-    dictionary.augment(args.dir, args.authors, args.diphthongs)
+    dictionary.augment(args.dir, args.authors, args.diphthongs, args.jobs, args.shards)
     dictionary.save(args.output)
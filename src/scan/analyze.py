@@ -4,6 +4,8 @@ from src.scan.scansion import Scansion
 from collections import defaultdict
 import warnings
 
+dummy_func = lambda *args: None  # function used if look up of a function fails
+
 
 def analyse(data):
     """
@@ -12,19 +14,50 @@ def analyse(data):
     :return: a dictionary with various statistical measurements
     """
     print("Analysis in progress...")
-    stats = defaultdict(dict)
-    dummy_func = lambda *args: None  # function used if look up of a function fails
+    analysis = Analysis()
     for verse in tqdm(data.values()):
+        analysis.add(verse)
+    return analysis.finalize()
+
+
+class Analysis:
+    """
+    Records statistics about scanned verses one at a time, so that a text can be analyzed while
+    it is being scanned without keeping all the verses in memory
+    """
+
+    def __init__(self):
+        """
+        Initialize a new Analysis object with no verses recorded
+        """
+        self.stats = defaultdict(dict)
+
+    def add(self, verse):
+        """
+        Record statistics about a verse
+        :param verse:   verse dictionary, as stored in the output file
+        :return:        None
+        """
         meter = Meter.METERS[verse["meter"]]
-        decomposition = meter.decompose(Scansion(verse["scansion"]), turn_off_assertions=True)
-        if len(decomposition) != 1:
-            warnings.warn("Multiple ways to decompose a scansion!")
-        decomposition = decomposition[0]
-        record_global(decomposition, verse, stats["global"])  # record global statistics
-        globals().get("record_" + meter.name, dummy_func)(decomposition, verse, stats[meter.name])
-    for key in stats:
-        globals().get("finalize_" + key, dummy_func)(stats[key])
-    return stats
+        if "feet" in verse:  # the decomposition was recorded during scansion
+            decomposition = [Scansion(foot) for foot in verse["feet"]]
+        else:
+            decomposition = meter.decompose(Scansion(verse["scansion"]), turn_off_assertions=True)
+            if len(decomposition) != 1:
+                warnings.warn("Multiple ways to decompose a scansion!")
+            decomposition = decomposition[0]
+        record_global(decomposition, verse, self.stats["global"])  # record global statistics
+        globals().get("record_" + meter.name, dummy_func)(decomposition, verse,
+                                                          self.stats[meter.name])
+
+    def finalize(self):
+        """
+        Calculate frequencies from the statistics recorded so far. No verses can be added after
+        :return: a dictionary with various statistical measurements
+        """
+        for key in self.stats:
+            globals().get("finalize_" + key, dummy_func)(self.stats[key])
+        return self.stats
 
 
 def record_trimeterDATI(decomposition, verse, stats):
@@ -94,7 +127,7 @@ def finalize_global(stats):
     :return:                None
     """
     total = sum([stats["method"][x] for x in stats["method"].keys()
-                 if x.split(" ")[0] not in ["total", "failed"]])
+                 if x.split(" ")[0] not in ["total", "failed", "timeout"]])
     stats["elision"].calculate_frequencies(total)
     stats["elision"] = stats["elision"].data
 
@@ -0,0 +1,113 @@
+"""
+This module provides a vectorized alternative to matching macronizations against a meter one by
+one. All the candidate macronizations of a verse (or of a chunk of verses) are packed into a 2D
+array and compared against the matrix of meter patterns in a single operation. Requires numpy.
+"""
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed in batch mode
+    np = None
+
+from src.scan.meter import PolyMeter
+
+
+class BatchMatcher:
+    """ Matches many Scansion objects against the patterns of a single meter at once """
+
+    BLOCK_SIZE = 4096  # number of macronizations compared against the meter at a time
+    MAX_SYLLABLES = 64  # patterns are packed into 64-bit integers
+
+    def __init__(self, meter, precise=False):
+        """
+        Initialize a new BatchMatcher object by packing the meter patterns into a matrix
+        :param meter:   a Meter object
+        :param precise: if True, will not use the UNK symbol for ancipites
+        """
+        if np is None:
+            raise ImportError("numpy is required to match scansions in batch mode")
+        self.meter = meter
+        self.precise = precise
+        self.scansions = meter.automaton.scansions
+        # the meter every pattern belongs to, if there are several (see PolyMeter.match_automaton)
+        self.owners = meter.owners if isinstance(meter, PolyMeter) else None
+        assert max(x.length for x in self.scansions) <= BatchMatcher.MAX_SYLLABLES
+        self.lengths = {x.length for x in self.scansions}
+        self.patterns = BatchMatcher.pack(self.scansions)
+
+    @staticmethod
+    def pack(scansions):
+        """
+        Pack a list of Scansion objects into a 2D array with one row per scansion. The columns
+        are the number of syllables, the bitmask of known syllables and the bitmask of long ones
+        :param scansions:   a list of Scansion objects
+        :return:            a numpy array of shape (len(scansions), 3)
+        """
+        return np.array([(x.length, x.known, x.long) for x in scansions],
+                        dtype=np.uint64).reshape(-1, 3)
+
+    def match(self, scansions):
+        """
+        Match a list of Scansion objects against the meter
+        :param scansions:   a list of Scansion objects
+        :return:            a list of (index of scansion in scansions, meter pattern) pairs,
+                            ordered by the index and then by the order of the meter patterns
+        """
+        # macronizations that have a wrong number of syllables (possibly too many to fit into
+        # 64 bits) cannot match any pattern and are left out before packing
+        indices = [i for i, x in enumerate(scansions) if x.length in self.lengths]
+        result = []
+        for start in range(0, len(indices), BatchMatcher.BLOCK_SIZE):
+            block = indices[start:start + BatchMatcher.BLOCK_SIZE]
+            candidates = BatchMatcher.pack([scansions[i] for i in block])
+            same_length = candidates[:, 0:1] == self.patterns[:, 0]
+            conflicts = (candidates[:, 2:3] ^ self.patterns[:, 2]) & \
+                candidates[:, 1:2] & self.patterns[:, 1]
+            rows, columns = np.nonzero(same_length & (conflicts == 0))
+            if self.owners is not None:  # keep the patterns of the first meter that matches
+                first = {}  # row -> the meter of its first matching pattern
+                pairs = [(row, column) for row, column in zip(rows, columns)
+                         if first.setdefault(row, self.owners[column]) == self.owners[column]]
+            else:
+                pairs = zip(rows, columns)
+            result += [(block[row], self.scansions[column]) for row, column in pairs]
+        if self.precise:
+            result = [(i, x) for i, pattern in result
+                      for x in pattern.precise_matchings(scansions[i])]
+        return result
+
+    def match_verses(self, verses):
+        """
+        Match all the macronizations of several verses against the meter at once
+        :param verses:  a list of Verse objects
+        :return:        a list with an entry for every verse. Each entry is a list of
+                        (macronization, meter pattern) pairs that can be passed to Verse.scan()
+        """
+        macronizations = []
+        owners = []  # index of the verse each macronization belongs to
+        for i, verse in enumerate(verses):
+            verse_macronizations = verse.macronize()
+            macronizations += verse_macronizations
+            owners += [i] * len(verse_macronizations)
+        result = [[] for _ in verses]
+        for i, pattern in self.match(macronizations):
+            result[owners[i]].append((macronizations[i], pattern))
+        return result
+
+
+if __name__ == "__main__":
+    # batch matching should give the same results as matching with the automaton one by one:
+    from src.scan.meter import Meter
+    from src.scan.scansion import Scansion
+    meter = PolyMeter([Meter.METERS[x] for x in ["trimeter", "trimeterDATI", "trimeterCORRER"]],
+                      "auto")
+    scansions = [Scansion(x) for x in [" o*pa_ca^ li_nqve*ns di_ti^s i_nfe*rni_ lo^ca*",
+                                       " a*dsu*m pro*fu*ndo* ta*rta*ri* e*mi*ssu*s spe*cu*",
+                                       " fu^gi^o_ thy_e^ste_s i_nfe^ro_s su^pe^ro_s fu^go_",
+                                       " a*rma_ vi^ru_mqve^ ca^no_ tro^i^[ae] qvi* pri^mu^s"]]
+    for precise in [False, True]:
+        matcher = BatchMatcher(meter, precise)
+        expected = [(i, x) for i, scansion in enumerate(scansions)
+                    for x in meter.match_pattern(scansion.pattern, precise)]
+        assert matcher.match(scansions) == expected
+    print("Batch matching agrees with the automaton")
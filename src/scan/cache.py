@@ -0,0 +1,90 @@
+"""
+This module provides a cache that persists between runs of the program. The cache is stored in an
+SQLite file and tagged with a fingerprint of everything its contents depend on (dictionary files,
+command line settings, etc.), so that it is invalidated automatically when any of these change.
+"""
+
+import hashlib
+import json
+import sqlite3
+
+
+class PersistentCache:
+    """ A key-value store kept on disk. Both keys and values must be JSON-serializable """
+
+    def __init__(self, filename, fingerprint):
+        """
+        Open (or create) a cache file. If the cache was created with a different fingerprint,
+        all its entries are discarded
+        :param filename:    the name of the SQLite file to store the cache in
+        :param fingerprint: a string that identifies the data the cached values depend on
+        """
+        self.filename = filename
+        self.key = fingerprint  # see PersistentCache.fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (fingerprint TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                                "(key TEXT PRIMARY KEY, value TEXT)")
+        stored = self.connection.execute("SELECT fingerprint FROM meta").fetchone()
+        self.outdated = stored is None or stored[0] != fingerprint  # True if the cache was reset
+        if self.outdated:
+            self.connection.execute("DELETE FROM meta")
+            self.connection.execute("DELETE FROM entries")
+            self.connection.execute("INSERT INTO meta VALUES (?)", (fingerprint, ))
+            self.connection.commit()
+
+    def get(self, key):
+        """
+        Look up a key in the cache
+        :param key: a JSON-serializable key
+        :return:    the cached value or None if there is none
+        """
+        row = self.connection.execute("SELECT value FROM entries WHERE key = ?",
+                                      (json.dumps(key), )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Store a value in the cache. The changes are written to disk when close() is called
+        :param key:     a JSON-serializable key
+        :param value:   a JSON-serializable value
+        :return:        None
+        """
+        self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)",
+                                (json.dumps(key), json.dumps(value)))
+
+    def stats(self):
+        """
+        Return the hit/miss counts of the lookups made since the cache was opened
+        :return: a dictionary
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """
+        Write all the changes to disk and close the file
+        :return: None
+        """
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def fingerprint(filenames, settings):
+        """
+        Compute a fingerprint of the given files and settings
+        :param filenames:   a list of names of the files the cached values depend on
+        :param settings:    a list of JSON-serializable settings the cached values depend on
+        :return:            a string
+        """
+        digest = hashlib.sha1(json.dumps(settings).encode("utf-8"))
+        for filename in filenames:
+            with open(filename, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+        return digest.hexdigest()
@@ -1,4 +1,72 @@
 from src.scan.scansion import *
+from src.utils import LRUCache
+from collections import defaultdict
+
+
+class MeterAutomaton:
+    """
+    A trie over quantity symbols compiled from a set of meter patterns. Since both the patterns
+    and the scansions matched against them may contain ancipites, a walk through the trie follows
+    a set of nodes rather than a single node.
+    """
+
+    def __init__(self, scansions):
+        """
+        Compile a set of meter patterns into a trie
+        :param scansions:   an iterable of Scansion objects
+        """
+        self.scansions = list(scansions)
+        self.children = [{}]  # node id -> {quantity symbol: child node id}, the root has id 0
+        self.accepting = defaultdict(list)  # node id -> [(position in scansions, Scansion object)]
+        for i, scansion in enumerate(self.scansions):
+            node = 0
+            for symbol in scansion.pattern:
+                if symbol not in self.children[node]:
+                    self.children[node][symbol] = len(self.children)
+                    self.children.append({})
+                node = self.children[node][symbol]
+            self.accepting[node].append((i, scansion))
+
+    def advance(self, states, pattern):
+        """
+        Walk the automaton along the given quantity symbols
+        :param states:  a set of node ids to start from (use {0} to start from the root)
+        :param pattern: a string of quantity symbols
+        :return:        a set of node ids. The set is empty if the symbols walked so far cannot be
+                        completed to match any meter pattern
+        """
+        for symbol in pattern:
+            new_states = set()
+            for state in states:
+                children = self.children[state]
+                if symbol == "*":
+                    new_states.update(children.values())
+                    continue
+                if symbol in children:
+                    new_states.add(children[symbol])
+                if "*" in children:
+                    new_states.add(children["*"])
+            if not new_states:
+                return new_states
+            states = new_states
+        return states
+
+    def accepted(self, states):
+        """
+        Return the meter patterns that end in the given set of nodes
+        :param states:  a set of node ids
+        :return:        a list of Scansion objects in the order they were compiled in
+        """
+        return [x[1] for x in sorted(x for state in states if state in self.accepting
+                                     for x in self.accepting[state])]
+
+    def match(self, pattern):
+        """
+        Return all the meter patterns that match a string of quantity symbols
+        :param pattern: a string of quantity symbols
+        :return:        a list of Scansion objects
+        """
+        return self.accepted(self.advance({0}, pattern))
 
 
 class Meter:
@@ -6,6 +74,9 @@ class Meter:
 
     METERS = {}  # dictionary of available meters.
     # Can also contain tuples of Meter objects: METERS["elegiacs"] = (HEXAMETER, PENTAMETER)
+    # results of matching shared by all meters and verses:
+    # (meter name, precise, quantity pattern) -> list of matching meter patterns
+    MATCH_CACHE = LRUCache(max_size=100000)
 
     def __init__(self, feet, name):
         """
@@ -24,6 +95,7 @@ class Meter:
                     tmp_scansions.add(existing + alternative)
             self.scansions = tmp_scansions
         self.__solve_conflicts()
+        self.automaton = MeterAutomaton(self.scansions)
 
     def get_matching_scansions(self, scansion, precise=False):
         """
@@ -32,16 +104,37 @@ class Meter:
         :param precise:  if True, will not use the UNK symbol for ancipites
         :return: a list of Scansion objects
         """
-        result = []
-        for meter_scansion in self:
-            if not precise and meter_scansion.matches(scansion):
-                result.append(meter_scansion)
-            elif precise:
-                for precise_meter_scansion in meter_scansion.precise_matchings():
-                    if precise_meter_scansion.matches(scansion):
-                        result.append(precise_meter_scansion)
+        return self.match_pattern(scansion.pattern, precise)
+
+    def match_pattern(self, pattern, precise=False):
+        """
+        Return all scansions in self.scansions that match the given string of quantity symbols.
+        The results are cached in Meter.MATCH_CACHE and should not be modified
+        :param pattern: a string of quantity symbols
+        :param precise: if True, will not use the UNK symbol for ancipites. Ancipites of the meter
+                        patterns are then resolved symbolically (see Scansion.precise_matchings)
+        :return: a list of Scansion objects
+        """
+        key = (self.name, precise, pattern)
+        result = Meter.MATCH_CACHE.get(key)
+        if result is None:
+            result = self.match_automaton(pattern)
+            if precise:
+                scansion = Scansion(pattern)
+                result = [x for meter_scansion in result
+                          for x in meter_scansion.precise_matchings(scansion)]
+            Meter.MATCH_CACHE.put(key, result)
         return result
 
+    def match_automaton(self, pattern):
+        """
+        Return the meter patterns that match the given string of quantity symbols, without
+        resolving their ancipites and without caching the result (see match_pattern())
+        :param pattern: a string of quantity symbols
+        :return:        a list of Scansion objects
+        """
+        return self.automaton.match(pattern)
+
     def decompose(self, scansion, turn_off_assertions=False):
         """
         Decompose a meter pattern into feet. E.g. this line of hexameter: "_^^___^^___^^_*"
@@ -57,9 +150,26 @@ class Meter:
         elif len(pattern) > 1 and turn_off_assertions:
             pattern = [pattern[0]]
         assert len(pattern) == 1
-        scansion = scansion.apply_mask(pattern[0])
+        return self.split_into_feet(scansion.apply_mask(pattern[0]))
+
+    def split_into_feet(self, scansion):
+        """
+        Decompose a scansion into feet without matching it against the meter again. This can be
+        used for scansions that have already been masked with a meter pattern (i.e. the ones
+        returned by Verse.scan)
+        :param scansion:    a Scansion object
+        :return:            a list of lists of Scansion objects
+        """
         return self.__recursively_decompose(scansion, 0)
 
+    def get_meters(self, scansion):
+        """
+        Return the meters the given scansion (one that matches this meter) can be scanned with
+        :param scansion:    a Scansion object
+        :return:            a list of Meter objects
+        """
+        return [self]
+
     def __recursively_decompose(self, scansion, feet_id):
         """
         A recursive method that performs what is described in the docstirng of decompose()
@@ -108,6 +218,77 @@ class Meter:
     def __iter__(self):
         return self.scansions.__iter__()
 
+
+class PolyMeter(Meter):
+    """
+    Represents a set of meters that the lines of a polymetric text can be scanned with. The
+    patterns of all the meters are compiled into a single automaton, so that a line is matched
+    against all of them at once. Can be used wherever a Meter object is used.
+    """
+
+    # meters used by default. Variants of a meter (e.g. trimeterCORRER) are left out, since they
+    # fit almost the same lines and would make the meter of most of them ambiguous
+    DEFAULT_METERS = ["hexameter", "pentameter", "trimeter"]
+
+    def __init__(self, meters, name):
+        """
+        Initialize a new PolyMeter object from a list of Meter objects
+        :param meters:  a list of Meter objects. If a line can be scanned with several of them,
+                        the first one is used to decompose it into feet
+        :param name:    name by which the set of meters is registered in Meter.METERS
+        """
+        self.meters = meters
+        self.feet = None
+        self.name = name
+        Meter.METERS[name] = self
+        self.scansions = [x for meter in meters for x in meter]
+        self.automaton = MeterAutomaton(self.scansions)
+        # position of a pattern in self.scansions -> position of its meter in self.meters
+        self.owners = [i for i, meter in enumerate(meters) for _ in meter]
+
+    def get_meters(self, scansion):
+        """
+        Return the meters the given scansion (one that matches this meter) can be scanned with
+        :param scansion:    a Scansion object
+        :return:            a list of Meter objects
+        """
+        return [meter for meter in self.meters if meter.match_pattern(scansion.pattern)]
+
+    def match_automaton(self, pattern):
+        """
+        Return the patterns of the first meter that matches the given string of quantity symbols.
+        The other meters would only resolve the ancipites of the same macronization differently
+        and make the scansion ambiguous, so their patterns are left out (see Meter.match_pattern)
+        :param pattern: a string of quantity symbols
+        :return:        a list of Scansion objects
+        """
+        states = self.automaton.advance({0}, pattern)
+        matches = sorted(x for state in states if state in self.automaton.accepting
+                         for x in self.automaton.accepting[state])
+        if not matches:
+            return []
+        owner = self.owners[matches[0][0]]
+        return [scansion for i, scansion in matches if self.owners[i] == owner]
+
+    def decompose(self, scansion, turn_off_assertions=False):
+        """
+        Decompose a scansion into the feet of the first meter it can be scanned with.
+        See Meter.decompose()
+        """
+        meters = self.get_meters(scansion)
+        if len(meters) == 0 and turn_off_assertions:
+            return [[]]
+        assert len(meters) > 0
+        return meters[0].decompose(scansion, turn_off_assertions)
+
+    def split_into_feet(self, scansion):
+        """
+        Decompose a scansion into the feet of the first meter it can be scanned with.
+        See Meter.split_into_feet()
+        """
+        return self.get_meters(scansion)[0].split_into_feet(scansion)
+
+
 print("Loading meters...")
 # disyllabics
 IAMB = SHORT + LONG
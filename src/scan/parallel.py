@@ -0,0 +1,310 @@
+"""
+This module scans the lines of a text, either one after another or in a pool of worker processes.
+Every worker receives the settings of the main process and attaches to the lexicons through the
+files they are shared in (see Word.share_lexicons), so that they are not copied. The results are
+returned in the order of the input, and the changes the workers make to Verse.DICT are applied
+in the same order in the main process. Results are reused for lines that are repeated in the
+text or that were scanned in a previous run (see Scanner.open_result_cache).
+"""
+
+from collections import deque
+from itertools import islice, tee
+from multiprocessing import Pool
+import tempfile
+
+from src.scan.batch import BatchMatcher
+from src.scan.cache import PersistentCache
+from src.scan.meter import Meter, PolyMeter
+from src.scan.verse import Verse
+from src.scan.word import Word
+from src.utils import LRUCache
+
+
+class Scanner:
+    """ Scans lines with a fixed meter (or a cycle of meters, like elegiacs) and settings """
+
+    CHUNK_SIZE = 64  # number of lines sent to a worker process at a time
+    QUEUE_SIZE = 4  # number of chunks per process that are scanned or waiting at a time
+    MEMORY_SIZE = 100000  # number of results kept in memory to be reused for repeated lines
+    RESULT_VERSION = 2  # change whenever the results stored in the result cache change
+    REPEATED = "repeated"  # marks a line that is identical to a line that is being scanned
+    # class attributes copied to the worker processes:
+    WORD_SETTINGS = ["DIPHTHONG", "TOTAL_COUNT", "AUTHOR_COUNT", "AUTHORS", "MORPHEUS_DICT",
+                     "MQDQ_DICT", "SOURCES"]
+    VERSE_SETTINGS = ["DICT", "CUTOFF", "BEAM_WIDTH", "TIME_LIMIT"]
+
+    def __init__(self, meters, precise=False, interactive=False, add_failed=False, batch=False):
+        """
+        Initialize a new Scanner object
+        :param meters:      a tuple of Meter objects. Line i is scanned with meters[i % len(meters)]
+        :param precise:     see Verse.scan()
+        :param interactive: see Verse.scan()
+        :param add_failed:  see Verse.scan()
+        :param batch:       if True, macronizations are matched with BatchMatcher objects
+        """
+        self.meters = meters
+        self.precise = precise
+        self.interactive = interactive
+        self.add_failed = add_failed
+        self.matchers = None
+        if batch:
+            self.matchers = [BatchMatcher(meter, precise) for meter in meters]
+        self.memory = LRUCache(max_size=Scanner.MEMORY_SIZE)  # results of this run
+        self.result_cache = None  # results of the previous runs, see open_result_cache()
+
+    def open_result_cache(self, filename):
+        """
+        Open the file in which the results are kept between runs, so that only the lines that
+        changed are scanned again. Cached results are discarded if any of the dictionaries, the
+        meters or the settings have changed, so this method should be called after the
+        dictionaries are loaded and the settings are set
+        :param filename:    the name of the cache file (None to not use a result cache)
+        :return:            None
+        """
+        if not filename:
+            return
+        meters = [[meter.name] + ([x.name for x in meter.meters]
+                                  if isinstance(meter, PolyMeter) else [])
+                  for meter in self.meters]
+        settings = [Scanner.RESULT_VERSION, meters, self.precise, Word.CACHE_VERSION,
+                    Word.DIPHTHONG, Word.AUTHOR_COUNT, Word.TOTAL_COUNT, Word.AUTHORS,
+                    Verse.CUTOFF, Verse.BEAM_WIDTH, Verse.TIME_LIMIT]
+        self.result_cache = PersistentCache(filename,
+                                            PersistentCache.fingerprint(Word.SOURCES, settings))
+
+    def close_result_cache(self):
+        """
+        Save the results to the result cache file, if one is used
+        :return: None
+        """
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
+
+    def scan_line(self, i, text):
+        """
+        Scan a single line
+        :param i:       the index of the line in the text
+        :param text:    the line
+        :return:        a dictionary with the results, as stored in the output file
+        """
+        return self.scan_lines([(i, text)])[0]
+
+    def scan_lines(self, lines):
+        """
+        Scan a chunk of lines. In batch mode, the macronizations of all the lines of the chunk
+        that are scanned with the same meter are matched against that meter at once
+        :param lines:   a list of (index of the line in the text, line) tuples
+        :return:        a list of dictionaries with the results, as stored in the output file
+        """
+        verses = [Verse(text) for _, text in lines]
+        matches = [None] * len(lines)
+        if self.matchers:
+            for j, matcher in enumerate(self.matchers):
+                group = [k for k, (i, _) in enumerate(lines) if i % len(self.meters) == j]
+                for k, verse_matches in zip(group, matcher.match_verses([verses[k]
+                                                                         for k in group])):
+                    matches[k] = verse_matches
+        return [self.__get_result(verse, self.meters[i % len(self.meters)], verse_matches)
+                for (i, _), verse, verse_matches in zip(lines, verses, matches)]
+
+    def __get_result(self, verse, meter, matches):
+        """
+        Scan a verse and collect the results
+        :param verse:   a Verse object
+        :param meter:   the meter to scan the verse with
+        :param matches: see Verse.scan()
+        :return:        a dictionary with the results, as stored in the output file
+        """
+        result = {"verse": verse.unaltered}
+        scansion = verse.scan(meter, self.precise, self.interactive, self.add_failed, matches)
+        if scansion:
+            result["scansion"] = str(scansion)
+            result["pattern"] = str(verse.pattern)
+        else:
+            result["scansion"], result["pattern"] = "", ""
+        result["feet"] = [str(foot) for foot in verse.feet]
+        result["confidence"] = verse.confidence
+        result["method"] = verse.scansion_method
+        result["flags"] = verse.flags
+        result["meter"] = meter.name
+        if isinstance(meter, PolyMeter) and verse.meters:
+            result["meter"] = verse.meters[0].name
+            result["meters"] = [x.name for x in verse.meters]
+        return result
+
+    def scan(self, lines, jobs=1):
+        """
+        Scan a sequence of lines. The lines are read lazily and at most a few chunks per process
+        are in progress at any time, so that memory use does not depend on the number of lines.
+        Lines whose results are known (see get_known_result()) are not scanned again
+        :param lines:   an iterable of strings
+        :param jobs:    number of processes to use. Interactive scansion is only possible with one
+        :return:        a generator that yields the results of scan_line() in the order of lines
+        """
+        in_progress = set()  # keys of the lines that are being scanned
+        entries, unknown = tee((i, line, self.get_known_result(i, line, in_progress))
+                               for i, line in enumerate(lines))
+        results = self.__scan(((i, line) for i, line, known in unknown if known is None), jobs)
+        for i, line, known in entries:
+            key = self.get_key(i, line)
+            if known is None:
+                result = next(results)
+                in_progress.discard(key)
+                self.remember(key, result)
+            elif known is Scanner.REPEATED:  # the first occurrence has been scanned by now
+                result = self.memory.get(key) or self.scan_line(i, line)
+            else:
+                result = known
+            yield dict(result, verse=line)
+
+    def __scan(self, lines, jobs):
+        """
+        Scan a sequence of lines without looking up their results
+        :param lines:   an iterable of (index of the line in the text, line) tuples
+        :param jobs:    number of processes to use
+        :return:        a generator that yields the results of scan_line() in the order of lines
+        """
+        if jobs <= 1 and self.matchers:  # batch matching works on chunks of lines
+            for chunk in Scanner.get_chunks(lines):
+                yield from self.scan_lines(chunk)
+            return
+        if jobs <= 1:
+            for i, line in lines:
+                yield self.scan_line(i, line)
+            return
+        assert not self.interactive
+        chunks = Scanner.get_chunks(lines)
+        with tempfile.TemporaryDirectory() as directory:
+            Word.share_lexicons(directory)
+            try:
+                with Pool(jobs, initializer=initialize_worker,
+                          initargs=(self.get_state(), )) as pool:
+                    pending = deque(pool.apply_async(scan_chunk, (chunk, ))
+                                    for chunk in islice(chunks, Scanner.QUEUE_SIZE * jobs))
+                    while pending:
+                        results, changes = pending.popleft().get()
+                        for chunk in islice(chunks, 1):
+                            pending.append(pool.apply_async(scan_chunk, (chunk, )))
+                        for verse_key, value in changes:
+                            Verse.DICT[verse_key] = value
+                        yield from results
+            finally:  # the workers are stopped by now, so the files can be unmapped
+                Word.unshare_lexicons()
+
+    def get_key(self, i, line):
+        """
+        Return the key under which the result for a line is reused
+        :param i:       the index of the line in the text
+        :param line:    the line
+        :return:        a (verse key, meter name) tuple
+        """
+        return Verse.get_verse_key(line), self.meters[i % len(self.meters)].name
+
+    def get_known_result(self, i, line, in_progress):
+        """
+        Look up the result for a line scanned earlier in this run or in a previous run. Lines
+        that are in Verse.DICT are always scanned again, since their manual scansion can change.
+        So are the lines that could not be scanned, if they have to be resolved interactively or
+        added to Verse.DICT
+        :param i:           the index of the line in the text
+        :param line:        the line
+        :param in_progress: a set with the keys of the lines that are being scanned. The key
+                            of the line is added to it, if the line has to be scanned
+        :return:            a result dictionary, Scanner.REPEATED if the same line is being
+                            scanned, or None if the line has to be scanned
+        """
+        key = self.get_key(i, line)
+        if key[0] in Verse.DICT:
+            return None
+        if key in in_progress:
+            return Scanner.REPEATED
+        result = self.memory.get(key)
+        if result is None and self.result_cache is not None:
+            result = self.result_cache.get(list(key))
+            if result is not None:
+                self.memory.put(key, result)
+        if result is not None and result["method"].startswith("failed") and \
+                (self.interactive or self.add_failed):
+            result = None  # scanning the line again prompts the user or adds it to Verse.DICT
+        if result is None:
+            in_progress.add(key)
+        return result
+
+    def remember(self, key, result):
+        """
+        Store the result for a line, so that it can be reused. Results that depend on the time
+        limit or on Verse.DICT are not stored
+        :param key:     the key returned by get_key()
+        :param result:  a dictionary returned by scan_line()
+        :return:        None
+        """
+        if key[0] in Verse.DICT or result["method"] == "timeout":
+            return
+        self.memory.put(key, result)
+        if self.result_cache is not None:
+            self.result_cache.put(list(key), result)
+
+    @staticmethod
+    def get_chunks(lines):
+        """
+        Split a sequence of lines into chunks of Scanner.CHUNK_SIZE lines
+        :param lines:   an iterable of (index of the line in the text, line) tuples
+        :return:        a generator of lists of such tuples
+        """
+        lines = iter(lines)
+        chunk = list(islice(lines, Scanner.CHUNK_SIZE))
+        while chunk:
+            yield chunk
+            chunk = list(islice(lines, Scanner.CHUNK_SIZE))
+
+    def __getstate__(self):
+        """ The results kept for reuse are not copied to the worker processes """
+        state = dict(self.__dict__)
+        state["memory"], state["result_cache"] = LRUCache(max_size=0), None
+        return state
+
+    def get_state(self):
+        """
+        Collect everything a worker process needs to scan lines the same way as this process
+        :return:    a picklable dictionary
+        """
+        return {"scanner": self,
+                "word": {name: getattr(Word, name) for name in Scanner.WORD_SETTINGS},
+                "verse": {name: getattr(Verse, name) for name in Scanner.VERSE_SETTINGS},
+                "word_cache_size": Word.CACHE.max_size,
+                "match_cache_size": Meter.MATCH_CACHE.max_size}
+
+
+SCANNER = None  # the Scanner object used by a worker process
+
+
+def initialize_worker(state):
+    """
+    Set up a worker process (see Scanner.get_state())
+    :param state:   the dictionary returned by Scanner.get_state()
+    :return:        None
+    """
+    global SCANNER
+    SCANNER = state["scanner"]
+    for name, value in state["word"].items():
+        setattr(Word, name, value)
+    for name, value in state["verse"].items():
+        setattr(Verse, name, value)
+    Word.CACHE.clear()
+    Word.CACHE.max_size = state["word_cache_size"]
+    Word.PERSISTENT_CACHE = None  # the cache file can only be written by one process
+    Meter.MATCH_CACHE.clear()
+    Meter.MATCH_CACHE.max_size = state["match_cache_size"]
+
+
+def scan_chunk(chunk):
+    """
+    Scan a chunk of lines in a worker process
+    :param chunk:   a list of (index of the line in the text, line) tuples
+    :return:        a (list of results of Scanner.scan_line(), list of changes to Verse.DICT) tuple
+    """
+    Verse.DICT_CHANGES = []
+    results = SCANNER.scan_lines(chunk)
+    changes, Verse.DICT_CHANGES = Verse.DICT_CHANGES, None
+    return results, changes
@@ -1,15 +1,53 @@
 import argparse
 import datetime
+from itertools import tee
 import json
 import sys
 from tqdm import tqdm
 import warnings
 
-from src.scan.analyze import analyse
-from src.scan.meter import Meter
+from src.scan.analyze import Analysis, analyse
+from src.scan.meter import Meter, PolyMeter
+from src.scan.parallel import Scanner
 from src.scan.verse import Verse
 from src.scan.word import Word
 
+
+def read_input(file, input_index):
+    """
+    Read the verses to scan from a file one at a time
+    :param file:        a file object with one verse per line
+    :param input_index: if True, every verse is preceded by its index and a tab
+    :return:            a generator of (index, verse) tuples
+    """
+    for i, line in enumerate(file):
+        if input_index:
+            yield tuple(line.rstrip("\n").split("\t"))
+        else:
+            yield str(i), line.rstrip("\n")
+
+
+def get_forms(entries):
+    """
+    Collect the keys under which the dictionaries will be queried when scanning the given verses
+    :param entries: an iterable of (index, verse) tuples
+    :return:        a set of strings (see Word.get_lexicon_keys)
+    """
+    return {key for _, verse in entries for word in Verse.tokenize(verse)
+            for key in Word.get_lexicon_keys(word)}
+
+
+def print_cache_stats(caches):
+    """
+    Print how many times each of the caches was hit and missed
+    :param caches:  a list of (name, cache) tuples, where every cache has a stats() method
+    :return:        None
+    """
+    for name, cache in caches:
+        stats = cache.stats()
+        print("{}: {} hits, {} misses".format(name, stats["hits"], stats["misses"]))
+
+
 # parse command line arguments:
 p = argparse.ArgumentParser(description="Scan a text")
 p.add_argument("input", type=argparse.FileType("r"),
@@ -17,13 +55,27 @@ p.add_argument("input", type=argparse.FileType("r"),
                     "preceded by a unique index and a tab (set -input_index to True in this case)")
 p.add_argument("output", type=argparse.FileType("w"),
                help="output file name (should end with .json)")
-p.add_argument("meter", type=str, choices=list(Meter.METERS.keys()),
-               help="meter to scan the text with")
+p.add_argument("meter", type=str, choices=list(Meter.METERS.keys()) + ["auto"],
+               help="meter to scan the text with. Use 'auto' to scan a polymetric text and "
+                    "detect the meter of every line among the ones specified with -meters")
+p.add_argument("-meters", type=str, nargs="+", default=None,
+               choices=[x for x in Meter.METERS.keys() if isinstance(Meter.METERS[x], Meter)],
+               help="meters to choose from when the meter is 'auto' (" +
+                    ", ".join(PolyMeter.DEFAULT_METERS) + " by default). If a line fits "
+                    "several of them, its ancipites are resolved with the first one")
 p.add_argument("-manual_file", type=str, default=None,
                help="file from which to read manual scansions and to which to write lines that "
                     "require manual scansions")
 p.add_argument("-dictionary", type=str, default=None,
                help="MQDQ dictionary file to use during scansion")
+p.add_argument("-snapshot", type=str, default=None,
+               help="binary file in which to keep the processed dictionaries between runs, which "
+                    "speeds up loading them. The file is rebuilt automatically when the "
+                    "dictionaries change")
+p.add_argument("-index", type=str, default=None,
+               help="SQLite file in which to keep the processed dictionaries indexed by word form. "
+                    "If specified, only the entries for the words in the input text are loaded. "
+                    "The file is rebuilt automatically when the dictionaries change")
 p.add_argument("-ac", type=int, default=3,
                help="If there is a way to scan a word which can only be find in MqDq dictionary "
                     "(such as pa_tri*s), this parameter specifies the number of authors the "
@@ -33,10 +85,34 @@ p.add_argument("-tc", type=int, default=5,
                     "(such as pa_tri*s), this parameter specifies the number of times this "
                     "scansion has to appear in the corpus for it to be considered valid by the "
                     "program")
+p.add_argument("-authors", type=str, nargs="+", default=None,
+               help="only use the MqDq scansions by these authors (e.g. Vergilius Ovidius). The "
+                    "counts of an author can be weighted by appending a colon and a weight to "
+                    "the name (e.g. Ovidius:0.5). The -ac and -tc thresholds are applied to the "
+                    "selected counts. All authors are used by default")
 p.add_argument("-cutoff", type=float, default=0.05,
                help="If there are two ways to scan a line and one way has this probability or lower"
                     ", the frequent scansion will be selected automatically without "
                     "consulting the user")
+p.add_argument("-word_cache_size", type=int, default=100000,
+               help="maximum number of word analyses to keep in memory, so that words that occur "
+                    "repeatedly in the text are only looked up and processed once")
+p.add_argument("-beam", type=int, default=None,
+               help="if specified, only this many ways of scanning the beginning of a line (the "
+                    "most frequent ones according to the MqDq dictionary) are kept after each "
+                    "word. This bounds the time and memory spent on very ambiguous lines, but the "
+                    "correct scansion may be missed. Lines affected are flagged in the output")
+p.add_argument("-time_limit", type=float, default=None,
+               help="maximum number of seconds to spend on scanning a line automatically. Lines "
+                    "that take longer are marked as timed out (and added to the manual file, if "
+                    "--add_failed_to_manual is used)")
+p.add_argument("-match_cache_size", type=int, default=100000,
+               help="maximum number of quantity patterns for which to remember the matching meter "
+                    "patterns, so that verses with the same quantities are only matched once")
+p.add_argument("-word_cache", type=str, default=None,
+               help="file in which to keep word analyses between runs. The file is "
+                    "invalidated automatically when the dictionaries or the -ac/-tc/diphthong "
+                    "settings change")
 p.add_argument("--precise", dest="precise", action="store_true",
                help="require the quantity of every syllable to be determined. This will, for "
                     "instance force the program to differentiate brevis in longo from longum at "
@@ -53,55 +129,123 @@ p.add_argument("--no_diphthongs", dest="diphthongs", action="store_false",
 p.add_argument("--add_failed_to_manual", dest="add_failed", action="store_true",
                help="if True, the lines that the program failed to scan will be added to the "
                     "manual file so that they can later be revisited")
+p.add_argument("--batch", dest="batch", action="store_true",
+               help="match all the possible macronizations of a verse against the meter at once "
+                    "using numpy instead of pruning them word by word. Cannot be combined with "
+                    "-time_limit or -beam, since all the macronizations are built in advance")
+p.add_argument("-jobs", type=int, default=1,
+               help="number of processes to scan the text with. The lines are scanned in chunks "
+                    "by worker processes that share the dictionaries, and the output is the same "
+                    "as with a single process. Cannot be combined with --interactive")
+p.add_argument("--stream", dest="stream", action="store_true",
+               help="read the input one line at a time and write the output in JSON Lines format, "
+                    "one record per verse as soon as it is scanned. The statistics are written "
+                    "as the final record, unless -stats_file is given. Memory use does not "
+                    "depend on the length of the text")
+p.add_argument("-stats_file", type=str, default=None,
+               help="file to write the statistics to in --stream mode (should end with .json)")
+p.add_argument("-result_cache", type=str, default=None,
+               help="file in which the results are kept between runs (an SQLite database). "
+                    "When a text is scanned again, only the lines that changed are scanned, and "
+                    "the results for the rest are taken from this file. The results are discarded "
+                    "if the dictionaries, meters or settings change")
 p.set_defaults(precise=False, input_index=False, interactive=False, diphthongs=True,
-               add_failed=False)
-args = p.parse_args(sys.argv[1:])
-if args.interactive and not args.manual_file:
-    warnings.warn("Scansions chosen in interactive mode are lost, if manual_file is not specified.")
-
-# load manually scanned lines into Verse dictionary:
-if args.manual_file:
-    Verse.read_manual_file(args.manual_file)
-
-Word.DIPHTHONGS = args.diphthongs
-Word.AUTHOR_COUNT = args.ac
-Word.TOTAL_COUNT = args.tc
-Word.load_mqdq_dict(args.dictionary)
-Word.load_morpheus_dict("data/MorpheusMacrons.txt")
-# Word.load_morpheus_dict("../../data/MorpheusMacrons.txt")
-Verse.CUTOFF = args.cutoff
-
-args.meter = Meter.METERS[args.meter]
-if not isinstance(args.meter, tuple):  # tuples are used for meters like elegiacs
-    args.meter = (args.meter, )
-lines = args.input.readlines()
-data = {"text": {}}
-
-print("Scansion in progress...")
-for i, line in enumerate(tqdm(lines)):
-    if args.input_index:
-        key, verse = line.rstrip("\n").split("\t")
+               add_failed=False, batch=False, stream=False)
+
+
+def main():
+    """
+    Scan a text as specified by the command line arguments (run with -h for their description)
+    :return: None
+    """
+    args = p.parse_args(sys.argv[1:])
+    if args.batch and (args.time_limit is not None or args.beam is not None):
+        p.error("--batch cannot be combined with -time_limit or -beam")
+    if args.interactive and not args.manual_file:
+        warnings.warn("Scansions chosen in interactive mode are lost, if manual_file is not "
+                      "specified.")
+    if args.interactive and args.jobs > 1:
+        warnings.warn("Interactive scansion is only possible with a single process.")
+        args.jobs = 1
+    if args.stats_file and not args.stream:
+        warnings.warn("-stats_file is only used in --stream mode. The statistics are written to "
+                      "the output file.")
+    if args.word_cache and args.jobs > 1:
+        warnings.warn("The persistent word cache is not used when scanning with several processes.")
+
+    # load manually scanned lines into Verse dictionary:
+    if args.manual_file:
+        Verse.read_manual_file(args.manual_file)
+
+    Word.DIPHTHONG = args.diphthongs
+    Word.AUTHOR_COUNT = args.ac
+    Word.TOTAL_COUNT = args.tc
+    Word.CACHE.max_size = args.word_cache_size
+    Meter.MATCH_CACHE.max_size = args.match_cache_size
+    if not args.stream:
+        entries = list(read_input(args.input, args.input_index))
+        forms = get_forms(entries)
+    elif args.index and args.input.seekable():  # the forms are collected in a separate pass
+        forms = get_forms(read_input(args.input, args.input_index))
+        args.input.seek(0)
+        entries = read_input(args.input, args.input_index)
     else:
-        key, verse = str(i), line.rstrip("\n")
-    data["text"][key] = {"verse": verse}
-    verse = Verse(verse)
-    curr_meter = args.meter[i % len(args.meter)]
-    scansion = verse.scan(curr_meter, args.precise, args.interactive, args.add_failed)
-    if scansion:
-        data["text"][key]["scansion"] = str(scansion)
-        data["text"][key]["pattern"] = \
-            str(curr_meter.get_matching_scansions(scansion, args.precise)[0])
+        entries, forms = read_input(args.input, args.input_index), None
+    Word.load_dictionaries(args.dictionary, "data/MorpheusMacrons.txt", args.snapshot, args.index,
+                           forms)
+    Word.select_authors(args.authors)
+    if args.jobs <= 1:
+        Word.open_persistent_cache(args.word_cache)
+    Verse.CUTOFF = args.cutoff
+    Verse.BEAM_WIDTH = args.beam
+    Verse.TIME_LIMIT = args.time_limit
+
+    if args.meter == "auto":
+        if not args.meters:
+            args.meters = PolyMeter.DEFAULT_METERS
+        PolyMeter([Meter.METERS[x] for x in args.meters], "auto")
+    args.meter = Meter.METERS[args.meter]
+    if not isinstance(args.meter, tuple):  # tuples are used for meters like elegiacs
+        args.meter = (args.meter, )
+    scanner = Scanner(args.meter, args.precise, args.interactive, args.add_failed, args.batch)
+    scanner.open_result_cache(args.result_cache)
+
+    print("Scansion in progress...")
+    keys, verses = tee(entries)  # entries can be a generator, which can only be read once
+    results = zip((key for key, _ in keys), scanner.scan((verse for _, verse in verses), args.jobs))
+    now = datetime.datetime.now()
+    created_on = {"day": now.day, "month": now.month, "year": now.year}
+    if args.stream:
+        analysis = Analysis()
+        for key, result in tqdm(results):
+            analysis.add(result)
+            args.output.write(json.dumps({"index": key, **result}) + "\n")
+            args.output.flush()
+        footer = {"stats": analysis.finalize(), "createdOn": created_on}
+        if args.stats_file:
+            with open(args.stats_file, "w") as file:
+                json.dump(footer, file, indent=2)
+        else:
+            args.output.write(json.dumps(footer) + "\n")
     else:
-        data["text"][key]["scansion"], data["text"][key]["pattern"] = "", ""
-    data["text"][key]["method"] = verse.scansion_method
-    data["text"][key]["flags"] = verse.flags
-    data["text"][key]["meter"] = curr_meter.name
-
-# run analysis on the scanned text
-data["stats"] = analyse(data["text"])
-now = datetime.datetime.now()
-data["createdOn"] = {"day": now.day, "month": now.month, "year": now.year}
-
-json.dump(data, args.output, indent=2)
-if args.manual_file:
-    Verse.save_manual_file(args.manual_file)
+        data = {"text": {}}
+        for key, result in tqdm(results, total=len(entries)):
+            data["text"][key] = result
+        # run analysis on the scanned text
+        data["stats"] = analyse(data["text"])
+        data["createdOn"] = created_on
+        json.dump(data, args.output, indent=2)
+
+    caches = [("Result cache", scanner.result_cache)]
+    if args.jobs <= 1:  # worker processes keep caches of their own
+        caches += [("Word cache", Word.CACHE), ("Persistent word cache", Word.PERSISTENT_CACHE),
+                   ("Meter match cache", Meter.MATCH_CACHE)]
+    print_cache_stats([(name, cache) for name, cache in caches if cache is not None])
+    Word.close_persistent_cache()
+    scanner.close_result_cache()
+    if args.manual_file:
+        Verse.save_manual_file(args.manual_file)
+
+
+if __name__ == "__main__":
+    main()
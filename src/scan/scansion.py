@@ -8,6 +8,9 @@ class Scansion:
     # and "*" - a syllable of unknown quantity.
     NON_QUANT_SYMBOLS = re.compile("[^\^_*]")
     DIPHTHONG = re.compile("\[[^\]]*\]")  # diphthongs are enclosed with brackets
+    # translation tables used to pack a pattern into bitmasks (the first syllable is the lowest bit)
+    KNOWN_BITS = str.maketrans("_^*", "110")
+    LONG_BITS = str.maketrans("_^*", "100")
 
     def __init__(self, scansion):
         """
@@ -18,6 +21,11 @@ class Scansion:
         self.scansion = scansion
         self.pattern = Scansion.DIPHTHONG.sub("_", self.scansion)  # replace [] with "long" symbol
         self.pattern = Scansion.NON_QUANT_SYMBOLS.sub("", self.pattern)  # remove non quant symbols
+        # the pattern packed into integers: number of syllables, a bitmask of syllables with known
+        # quantity and a bitmask of long syllables
+        self.length = len(self.pattern)
+        self.known = int("0" + self.pattern[::-1].translate(Scansion.KNOWN_BITS), 2)
+        self.long = int("0" + self.pattern[::-1].translate(Scansion.LONG_BITS), 2)
 
     def matches(self, scansion):
         """
@@ -26,12 +34,9 @@ class Scansion:
         :param scansion:    another Scansion object
         :return:            a boolean
         """
-        if len(self.pattern) != len(scansion.pattern):
+        if self.length != scansion.length:
             return False
-        for i, syl in enumerate(self.pattern):
-            if syl != scansion.pattern[i] and syl != "*" and scansion.pattern[i] != "*":
-                return False
-        return True
+        return not (self.long ^ scansion.long) & self.known & scansion.known
 
     def apply_mask(self, mask):
         """
@@ -51,13 +56,23 @@ class Scansion:
                 syllable_id += 1
         return Scansion(new_scansion)
 
-    def precise_matchings(self):
+    def precise_matchings(self, scansion=None):
         """
         Returns a list of matching scansions that do not use the anceps quantity symbol (*)
         E.g.: Scansion("*_").precise_matchings() will return [Scansion("^_"), Scansion("__")]
+        If another (matching) scansion is given, only the precise scansions that also match it are
+        returned. Ancipites are then resolved symbolically, i.e. their quantity is taken from that
+        scansion wherever it is known, and only syllables unknown in both are expanded:
+        Scansion("**_").precise_matchings(Scansion("_*_")) will return [Scansion("___"),
+        Scansion("_^_")]
+        :param scansion:    None or another Scansion object that matches this one
         :return: a list of Scansion objects
         """
-        return [Scansion(x) for x in self.__recursive_precise_matchings(self.pattern)]
+        pattern = self.pattern
+        if scansion is not None:
+            pattern = "".join(scansion.pattern[i] if syl == "*" else syl
+                              for i, syl in enumerate(self.pattern))
+        return [Scansion(x) for x in self.__recursive_precise_matchings(pattern)]
 
     def __recursive_precise_matchings(self, string):
         """
@@ -82,10 +97,10 @@ class Scansion:
         :param scansion:    another Scansion object
         :return:            a boolean
         """
-        if len(self.pattern) >= len(scansion.pattern) and \
-                Scansion(self.pattern[:len(scansion.pattern)]).matches(scansion):
-            return True
-        return False
+        if self.length < scansion.length:
+            return False
+        # the bits of scansion past its length are zero, so only the first syllables are compared
+        return not (self.long ^ scansion.long) & self.known & scansion.known
 
     def divide_by(self, scansion):
         """
@@ -135,10 +150,11 @@ class Scansion:
         return self.__str__()
 
     def __hash__(self):
-        return self.pattern.__hash__()
+        return hash((self.length, self.known, self.long))
 
     def __eq__(self, other):
-        return self.pattern == other.pattern
+        return self.length == other.length and self.known == other.known and \
+            self.long == other.long
 
     def __add__(self, other):
         return Scansion(self.scansion + " " + other.scansion)
@@ -171,6 +187,7 @@ if __name__ == "__main__":
     assert patresque_l.apply_mask(patresque_u).scansion == patresque_u.scansion
     assert patresque_l in patresque_u.precise_matchings()
     assert patresque_s in patresque_u.precise_matchings()
+    assert patresque_u.precise_matchings(patresque_s) == [patresque_s]
     assert patresque_u.begins_with(patres_l)
     assert not patresque_s.begins_with(patres_l)
 
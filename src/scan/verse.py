@@ -2,17 +2,28 @@ from src.scan.word import Word
 from src.scan.scansion import Scansion
 from src.utils import *
 import math
-from copy import deepcopy
+import time
 import warnings
 import re
 
 
+class ScanTimeout(Exception):
+    """ Raised when scanning a verse takes longer than Verse.TIME_LIMIT """
+    pass
+
+
 class Verse:
     """ Represents a single verse of poetry """
 
     DICT = {}  # dictionary of manual scansion. If a verse is in the dictionary, the scansion
     # returned by scan() will be from this dictionary
+    DICT_CHANGES = None  # if a list, changes made to DICT by scan() are recorded in it
     CUTOFF = 0.05  # see scan.py command line argument description
+    BEAM_WIDTH = None  # see scan.py command line argument description (None - no pruning)
+    TIME_LIMIT = None  # see scan.py command line argument description (None - no limit)
+    NON_ALPHABETIC = re.compile(r"([^a-z])")  # see Verse.tokenize()
+    SPACES = re.compile(" +")
+    KEY_SEPARATORS = re.compile(r"( *[^a-zA-Z] *|[ ]+)")  # see Verse.get_verse_key()
 
     def __init__(self, verse):
         """
@@ -21,55 +32,113 @@ class Verse:
         """
         self.unaltered = verse
         self.verse_key = Verse.get_verse_key(verse)
-        verse = re.sub(r"([^a-z])", " ", verse.lower()).rstrip(" ").lstrip(" ")
-        verse = re.sub(" +", " ", verse).split(" ")
+        verse = Verse.tokenize(verse)
         self.words = [Word(verse[-1], None)]
         for i in range(len(verse) - 2, -1, -1):  # in reverse order because of how elision works
             self.words.insert(0, Word(verse[i], self.words[0]))
-        self.__macronize()
         self.flags = []
+        self.pattern = None  # the meter pattern of the scansion chosen by scan()
+        self.meters = []  # the meters the scansion chosen by scan() fits (see PolyMeter)
+        self.feet = []  # the scansion chosen by scan() divided into feet
+        self.ranking = []  # scansion options ranked by scan(), see rank()
+        self.confidence = None  # confidence of the scansion chosen by scan(), if it was ranked
+        self.__meter_patterns = {}  # quantity pattern of a scansion option -> meter pattern used
+        # quantity pattern of a scansion option -> the scansion before the meter pattern was applied
+        self.__macronizations = {}
+        self.__deadline = None  # time by which scan() has to finish, see Verse.TIME_LIMIT
 
-    def __macronize(self):
+    def macronize(self):
         """
-        Populate self.macronizations, with all possible ways the line can be macronized
-        :return:
+        Return all possible ways the line can be macronized regardless of meter. The number of
+        macronizations grows exponentially with the number of ambiguous words, so this is only
+        used for batch matching (see batch.py)
+        :return: a list of Scansion objects
         """
-        self.macronizations = [Scansion("")]
-        for i, word in enumerate(self.words):
-            new_macrons = []
-            for exist in self.macronizations:
-                for macrons in word.macronize():
-                    new_macrons.append(exist + macrons)
-            self.macronizations = new_macrons
+        macronizations = [Scansion("")]
+        for word in self.words:
+            word_macrons = word.macronize()
+            macronizations = [exist + macrons for exist in macronizations
+                              for macrons in word_macrons]
+        return macronizations
 
-    def score_scansions(self, scansion1, scansion2):
+    def __get_matches(self, meter, precise):
         """
-        Take two scansions a and b.
-        For each word i compute p(i_a) and p(i_b),
-        probabilities that word i would be scanned as in a and b respectively.
-
-        Compute p(a) as the product of p(i_a)'s and p(b) as the product of p(i_b)'s
-
-        Return the most likely of the two scansions and
-        either p(a)/(p(a) + p(b)) or p(b) / (p(a) + p(b)), whichever is greater.
+        Return all the ways the line can be macronized so as to match the meter. Macronizations
+        are built word by word from left to right and a partial macronization is dropped as soon
+        as it can no longer be completed to match any of the meter patterns. If Verse.BEAM_WIDTH
+        is set, only that many partial macronizations (the most probable ones, with words weighed
+        as in Verse.rank) are kept after each word, and the pruning is recorded in self.flags
+        :param meter:   the meter to use as a constraint for the scansion
+        :param precise: whether to allow anceps symbols in the final scansion
+        :return:        a list of (macronization, meter pattern) pairs
+        """
+        automaton = meter.automaton
+        paths = [("", "", 0)]  # (partial macronization, its quantity pattern, log-probability)
+        states = {"": {0}}  # quantity pattern -> automaton nodes reached by it
+        pruned = False
+        for word in self.words:
+            word_macrons = word.macronize()
+            if Verse.BEAM_WIDTH is not None:
+                weights = word.weigh_scansions(x.scansion for x in word_macrons)
+                total = sum(weights.values())
+                log_ps = [math.log(weights[x.scansion] / total) for x in word_macrons]
+            else:
+                log_ps = [0] * len(word_macrons)
+            new_paths = []
+            for scansion, pattern, log_p in paths:
+                self.__check_time()
+                for macrons, word_log_p in zip(word_macrons, log_ps):
+                    new_pattern = pattern + macrons.pattern
+                    if new_pattern not in states:
+                        states[new_pattern] = automaton.advance(states[pattern], macrons.pattern)
+                    if states[new_pattern]:
+                        new_paths.append((scansion + " " + macrons.scansion, new_pattern,
+                                          log_p + word_log_p))
+            if Verse.BEAM_WIDTH is not None and len(new_paths) > Verse.BEAM_WIDTH:
+                best = sorted(range(len(new_paths)), key=lambda x: -new_paths[x][2])
+                new_paths = [new_paths[x] for x in sorted(best[:Verse.BEAM_WIDTH])]
+                pruned = True
+            paths = new_paths
+        if pruned:
+            self.flags.append("Pruned to {} partial scansions per word".format(Verse.BEAM_WIDTH))
 
-        Note that the actual computation is somewhat simplified.
+        matches = []
+        for scansion, pattern, _ in paths:
+            macronization = Scansion(scansion)
+            matches += [(macronization, meter_pattern)
+                        for meter_pattern in meter.match_pattern(pattern, precise)]
+        return matches
 
-        :param scansion1: the first scansion (a)
-        :param scansion2: the second scansion (b)
-        :return:          a Scansion (either a or b), a float that lies in (0.5, 1)
-        """
-        p_1 = 1
-        p_2 = 1
-        word_scansions_1 = scansion1.scansion.lstrip(" ").rstrip(" ").split(" ")
-        word_scansions_2 = scansion2.scansion.lstrip(" ").rstrip(" ").split(" ")
+    def rank(self, options, n=None):
+        """
+        Rank scansion options by their probability in a single pass.
+        For each word i, the ways a of scanning it that occur among the options are weighed by the
+        MqDq entries that tell them apart (see Word.weigh_scansions), and p(i_a) is the weight of a
+        divided by the sum of the weights. The probability of an option is the product of p(i_a)
+        over all words, and the confidences are these probabilities normalized so that they sum to
+        one over all the options. For two options this is the same as comparing them word by word
+        with Word.compare_scansions
+        :param options: an iterable of Scansion objects
+        :param n:       the number of best options to return (all options if None)
+        :return:        a list of (Scansion, confidence) tuples sorted by decreasing confidence
+        """
+        options = list(options)
+        if len(options) < 2:
+            return [(option, 1.0) for option in options]
+        macrons = [option.scansion.lstrip(" ").rstrip(" ").split(" ") for option in options]
+        log_ps = []  # word index -> {way to scan the word: log p(i_a)}
         for i, word in enumerate(self.words):
-            p_word_1, _ = word.compare_scansions(word_scansions_1[i], word_scansions_2[i])
-            p_1 *= p_word_1
-            p_2 *= (1 - p_word_1)
-        if p_1 > p_2:
-            return scansion1, p_1/(p_1 + p_2)
-        return scansion2, p_2 / (p_1 + p_2)
+            self.__check_time()
+            weights = word.weigh_scansions(x[i] for x in macrons)
+            total = sum(weights.values())
+            log_ps.append({x: math.log(weights[x] / total) for x in weights})
+        log_probabilities = [sum(log_ps[i][x] for i, x in enumerate(option_macrons))
+                             for option_macrons in macrons]
+        best = max(log_probabilities)
+        weights = [math.exp(x - best) for x in log_probabilities]
+        total = sum(weights)
+        ranking = sorted(zip(options, [x / total for x in weights]), key=lambda x: -x[1])
+        return ranking[:n]
 
     def update_flags(self, scansion):
         """
@@ -86,7 +155,7 @@ class Verse:
             if self.words[i].is_new:
                 self.flags.append("A previuosly unencountered word: " + macrons)
 
-    def scan(self, meter, precise=False, interactive=True, add_failed=False):
+    def scan(self, meter, precise=False, interactive=True, add_failed=False, matches=None):
         """
         Return the scansion for this line or None if correct scansion cannot be determined
         :param meter:       the meter to use as a constraint for the scansion
@@ -96,21 +165,70 @@ class Verse:
         :param add_failed:  If True, the lines that the program failed to scan will be added
                             to Verse.DICT, so that they can later be scanned manually in the
                             manual file
-        :return:            Scansion object or None
+        :param matches:     (macronization, meter pattern) pairs computed in advance (e.g. by
+                            BatchMatcher.match_verses). If None, they are computed by this method
+        :return:            Scansion object or None. The meter pattern of the scansion and its
+                            division into feet are stored in self.pattern and self.feet
+        """
+        if Verse.TIME_LIMIT is not None:
+            self.__deadline = time.monotonic() + Verse.TIME_LIMIT
+        try:
+            if matches is None:
+                matches = self.__get_matches(meter, precise)
+            options = set()
+            for macronization, pattern in matches:
+                option = macronization.apply_mask(pattern)
+                options.add(option)
+                self.__meter_patterns.setdefault(option.pattern, pattern)
+                self.__macronizations.setdefault(option.pattern, macronization)
+                # TODO consider a very rare but theoretically possible case, when to scansions
+                # are the same, but words are macronized diffrently
+            self.ranking = self.rank(options)
+        except ScanTimeout:
+            scansion = self.__time_out(meter, precise, add_failed)
+        else:
+            manual_options = self.__get_manual_options(meter, precise)
+            if len(options) > 1 and len(manual_options) != 1:
+                options = self.__resolve(options, interactive)
+            scansion = self.__finish_scansion(options, manual_options, add_failed)
+        if scansion:
+            self.confidence = dict(self.ranking).get(scansion)
+            self.pattern = self.__meter_patterns[scansion.pattern]
+            macronization = self.__macronizations.get(scansion.pattern, scansion)
+            self.meters = meter.get_meters(macronization)
+            decompositions = meter.split_into_feet(scansion)
+            if len(decompositions) != 1:
+                warnings.warn("Multiple ways to decompose a scansion!")
+            self.feet = decompositions[0] if decompositions else []
+        return scansion
+
+    def __check_time(self):
         """
-        options = set()
-        for i, macronization in enumerate(self.macronizations):
-            meter_patterns = meter.get_matching_scansions(macronization, precise)
-            for pattern in meter_patterns:
-                scansion = macronization.apply_mask(pattern)
-                options.add(scansion)
-                # TODO consider a very rare but theoretically possible case, when to scansions are
-                # the same, but words are macronized diffrently
+        Raise ScanTimeout if scan() has been running for longer than Verse.TIME_LIMIT
+        :return: None
+        """
+        if self.__deadline is not None and time.monotonic() > self.__deadline:
+            raise ScanTimeout()
 
+    def __time_out(self, meter, precise, add_failed):
+        """
+        Finish the scansion of a line that could not be scanned automatically in the time allotted.
+        A manual scansion is still used if there is one, otherwise the line is marked as timed out
+        :param meter:       the meter to scan the verse with
+        :param precise:     whether to allow anceps symbols in the final scansion
+        :param add_failed:  If True, the line will be added to Verse.DICT, so that it can later be
+                            scanned manually in the manual file
+        :return:            Scansion object or None
+        """
+        self.flags.append("Automatic scansion timed out")
         manual_options = self.__get_manual_options(meter, precise)
-        if len(options) > 1 and len(manual_options) != 1:
-            options = self.__resolve(options, interactive)
-        return self.__finish_scansion(options, manual_options, add_failed)
+        if len(manual_options) == 1:
+            return self.__finish_scansion(set(), manual_options, add_failed)
+        self.scansion_method = "timeout"
+        if add_failed and self.verse_key not in Verse.DICT:
+            Verse.update_dict(self.verse_key, {"scansion": self.unaltered,
+                                               "comment": "toBeScanned"})
+        return None
 
     def __resolve_automatically(self, options):
         """
@@ -118,13 +236,9 @@ class Verse:
         :param options:
         :return:
         """
-        options_copy = deepcopy(options)
-        best_option = options_copy.pop()
-        while options_copy:
-            new_option = options_copy.pop()
-            best_option, score = self.score_scansions(best_option, new_option)
-            if (1 - score) > Verse.CUTOFF:
-                return options
+        best_option, confidence = self.ranking[0]
+        if (1 - confidence) > Verse.CUTOFF:
+            return options
         self.flags.append("Resolved Automatically")
         return {best_option, }
 
@@ -150,7 +264,7 @@ class Verse:
             answer = input()
         if int(answer) == i + 1:
             return options
-        Verse.DICT[self.verse_key] = {"scansion": scansions[int(answer)], "comment": ""}
+        Verse.update_dict(self.verse_key, {"scansion": scansions[int(answer)], "comment": ""})
         return {scansions[int(answer)], }
 
     def __get_manual_options(self, meter, precise):
@@ -164,9 +278,14 @@ class Verse:
         if self.verse_key not in Verse.DICT:
             return manual_options
         line_scansion = Verse.DICT[self.verse_key]["scansion"]
+        if not isinstance(line_scansion, Scansion):  # an unscanned line added during this run
+            return manual_options
         meter_patterns = meter.get_matching_scansions(line_scansion, precise)
         for pattern in meter_patterns:
-            manual_options.add(line_scansion.apply_mask(pattern))
+            option = line_scansion.apply_mask(pattern)
+            manual_options.add(option)
+            self.__meter_patterns.setdefault(option.pattern, pattern)
+            self.__macronizations.setdefault(option.pattern, line_scansion)
         if len(manual_options) != 1:
             warnings.warn("Scansion for line " + self.verse_key + " specified manually is "
                                                                   "not acceptable")
@@ -191,7 +310,8 @@ class Verse:
                 self.update_flags(scansion)
                 return scansion
             if add_failed:
-                Verse.DICT[self.verse_key] = {"scansion": self.unaltered, "comment": "toBeScanned"}
+                Verse.update_dict(self.verse_key, {"scansion": self.unaltered,
+                                                   "comment": "toBeScanned"})
             if len(auto_options) == 0:
                 self.scansion_method = "failed"
             else:
@@ -199,8 +319,8 @@ class Verse:
             return None
         if len(manual_options) != 1:
             self.scansion_method = "failed"
-            Verse.DICT[self.verse_key] = {"scansion": self.unaltered,
-                                          "comment": "toBeScanned"}
+            Verse.update_dict(self.verse_key, {"scansion": self.unaltered,
+                                               "comment": "toBeScanned"})
             return None
         scansion = manual_options.pop()
         if len(auto_options) == 0:
@@ -219,6 +339,16 @@ class Verse:
                 self.scansion_method = "manual (corrected)"
         return scansion
 
+    @staticmethod
+    def tokenize(verse):
+        """
+        Split a verse into words made of lowercase alphabetical characters only
+        :param verse:   the verse as it appears in text
+        :return:        a list of strings
+        """
+        verse = Verse.NON_ALPHABETIC.sub(" ", verse.lower()).rstrip(" ").lstrip(" ")
+        return Verse.SPACES.sub(" ", verse).split(" ")
+
     @staticmethod
     def get_verse_key(verse):
         """
@@ -227,8 +357,7 @@ class Verse:
         :param verse:   the verse as it appears in text
         :return:        a string
         """
-        key = re.sub(r"( *[^a-zA-Z] *|[ ]+)", "", verse).lower()
-        return multireplace(key, {"j": "i", "v": "u"})
+        return KEY_NORMALIZER(Verse.KEY_SEPARATORS.sub("", verse).lower())
 
     @staticmethod
     def read_manual_file(filename):
@@ -246,12 +375,25 @@ class Verse:
         for line in lines:
             verse_key = Verse.get_verse_key(line[0])
             scansion = re.sub(r"([^a-z_\^*\[\]()])", " ", line[0].lower()).rstrip(" ").lstrip(" ")
-            scansion = Scansion(re.sub(" +", " ", scansion))
+            scansion = Scansion(Verse.SPACES.sub(" ", scansion))
             if len(line) == 1:
                 Verse.DICT[verse_key] = {"scansion": scansion, "comment": ""}
             else:
                 Verse.DICT[verse_key] = {"scansion": scansion, "comment": line[1]}
 
+    @staticmethod
+    def update_dict(verse_key, value):
+        """
+        Set an entry in Verse.DICT and record the change in Verse.DICT_CHANGES, if it is a list.
+        This is how worker processes report the changes that have to be merged (see parallel.py)
+        :param verse_key:   the key of the verse (see get_verse_key())
+        :param value:       a dictionary {"scansion": ..., "comment": ...}
+        :return:            None
+        """
+        Verse.DICT[verse_key] = value
+        if Verse.DICT_CHANGES is not None:
+            Verse.DICT_CHANGES.append((verse_key, value))
+
     @staticmethod
     def save_manual_file(filename):
         """
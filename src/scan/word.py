@@ -1,8 +1,11 @@
 from src.utils import *
 import warnings
+import os
+import pickle
 # import joblib
 from tqdm import tqdm
 from src.scan.scansion import Scansion
+from src.scan.cache import PersistentCache
 from src.mqdq.dictionary import MqDqDictionary
 from collections import defaultdict
 
@@ -15,9 +18,17 @@ class Word:
     DIPHTHONG = True
     TOTAL_COUNT = 10
     AUTHOR_COUNT = 3
+    AUTHORS = None  # authors (with weights) to use MqDq data from, see Word.select_authors()
 
-    MORPHEUS_DICT = defaultdict(set)
+    MORPHEUS_DICT = CompactLexicon(counts=False)
     MQDQ_DICT = MqDqDictionary()
+    # finished analyses of words keyed by (form, next word prefix, DIPHTHONG, AUTHOR_COUNT,
+    # TOTAL_COUNT, AUTHORS). See scan.py command line arguments description for the size limit
+    CACHE = LRUCache(max_size=100000)
+    PERSISTENT_CACHE = None  # a PersistentCache object, see Word.open_persistent_cache()
+    CACHE_VERSION = 2  # change whenever the attributes stored in PERSISTENT_CACHE change
+    SOURCES = []  # names of the dictionary files loaded so far
+    SNAPSHOT_VERSION = 5  # change whenever the processing of the dictionaries changes
 
     def __init__(self, word, next_word):
         """
@@ -31,14 +42,24 @@ class Word:
                 self.next_word_prefix = next_word.__get_prefix()
             except:
                 self.next_word_prefix = None
+        key = (word, self.next_word_prefix, Word.DIPHTHONG, Word.AUTHOR_COUNT, Word.TOTAL_COUNT,
+               Word.AUTHORS)
+        cached = Word.CACHE.get(key)
+        if cached is None and Word.PERSISTENT_CACHE is not None:
+            cached = Word.__deserialize(Word.PERSISTENT_CACHE.get([word, self.next_word_prefix]))
+            if cached is not None:
+                Word.CACHE.put(key, cached)
+        if cached is not None:
+            self.__dict__.update(cached)
+            self.scansions = set(self.scansions)
+            return
         # checking if the word has a postfix like que
         self.word = word  # word - postfix like que, if there is one
         self.scansions = self.__look_up()
         self.__check_if_has_postfix(self.next_word_prefix)
         if self.postfix != "":
             self.scansions = self.__look_up()
-            self.next_word_prefix = multireplace(Word.PREFIX.match(self.postfix).group(),
-                                            {"u": "v", "j": "i"})
+            self.next_word_prefix = Word.PREFIX_NORMALIZER(Word.PREFIX.match(self.postfix).group())
 
         # workaround for cases when a word is completely unknown
         self.is_new = len(self.scansions) == 0
@@ -47,6 +68,63 @@ class Word:
 
         for scansion in self.scansions:
             self.__process(scansion, self.next_word_prefix)
+        self.mqdq_frequencies = self.__get_mqdq_frequencies()
+        Word.CACHE.put(key, self.__dict__.copy())
+        if Word.PERSISTENT_CACHE is not None:
+            Word.PERSISTENT_CACHE.put([word, self.next_word_prefix],
+                                      Word.__serialize(self.__dict__))
+
+    @staticmethod
+    def __serialize(attributes):
+        """
+        Convert the attributes of a Word object into a form that can be stored in PersistentCache
+        :param attributes:  the __dict__ of a Word object
+        :return:            a JSON-serializable dictionary
+        """
+        result = dict(attributes)
+        result["scansions"] = [[x.scansion, x.isMqDq] for x in attributes["scansions"]]
+        result["mqdq_frequencies"] = [[x.scansion, count]
+                                      for x, count in attributes["mqdq_frequencies"]]
+        return result
+
+    @staticmethod
+    def __deserialize(data):
+        """
+        Convert the value returned by __serialize() back into the attributes of a Word object
+        :param data:    a dictionary or None
+        :return:        a dictionary or None
+        """
+        if data is None:
+            return None
+        data["scansions"] = {WordScansion(x[0], x[1]) for x in data["scansions"]}
+        data["mqdq_frequencies"] = [(Scansion(x[0]), x[1]) for x in data["mqdq_frequencies"]]
+        return data
+
+    @staticmethod
+    def open_persistent_cache(filename):
+        """
+        Open the file in which word analyses are kept between runs. Cached analyses are discarded
+        if any of the dictionaries loaded so far or any of the settings have changed, so this
+        method should be called after the dictionaries are loaded
+        :param filename:    the name of the cache file (None to not use a persistent cache)
+        :return:            None
+        """
+        if not filename:
+            return
+        settings = [Word.CACHE_VERSION, Word.DIPHTHONG, Word.AUTHOR_COUNT, Word.TOTAL_COUNT,
+                    Word.AUTHORS]
+        Word.PERSISTENT_CACHE = PersistentCache(filename,
+                                                PersistentCache.fingerprint(Word.SOURCES, settings))
+
+    @staticmethod
+    def close_persistent_cache():
+        """
+        Save the word analyses to the persistent cache file, if one is used
+        :return: None
+        """
+        if Word.PERSISTENT_CACHE is not None:
+            Word.PERSISTENT_CACHE.close()
+            Word.PERSISTENT_CACHE = None
 
     def __process(self, word_scansion, next_word_prefix):
         scansion = word_scansion.scansion
@@ -124,38 +202,65 @@ class Word:
     def is_morpheus_only(self, scansion):
         pass
 
+    def __get_mqdq_frequencies(self):
+        """
+        Process every MqDq entry of the word in the context of the verse and record how many
+        times it occurs in the corpus
+        :return: a list of (Scansion, integer count) tuples
+        """
+        key = KEY_NORMALIZER(self.word)
+        frequencies = []
+        for entry, total, _ in Word.MQDQ_DICT.look_up_stats(key):
+            mqdq_scansion = WordScansion(entry, True)
+            self.__process(mqdq_scansion, self.next_word_prefix)
+            frequencies.append((Scansion(mqdq_scansion.scansion), total))
+        return frequencies
+
+    def __strip_postfix(self, scansion):
+        """
+        Return the quantity pattern of a way to scan this word (as it appears in a verse
+        scansion) without the short postfix, so that it can be compared to MqDq entries
+        :param scansion: a string
+        :return:         a Scansion object
+        """
+        if (len(self.postfix) != 0) and ("(" not in self.postfix):
+            return Scansion(Scansion(scansion).pattern[:-1])
+        return Scansion(scansion)
+
+    def weigh_scansions(self, scansions):
+        """
+        Weigh several ways of scanning the word by the MqDq entries that tell them apart. An entry
+        counts for a scansion if it matches that scansion but not all of the others, so entries
+        with an anceps where the scansions differ are ignored. If some scansion is not supported
+        by any such entry, one is added to every count (a scansion is never ruled out completely)
+        :param scansions: an iterable of strings
+        :return:          a dictionary {scansion: weight}
+        """
+        scansions = set(scansions)
+        stripped = {x: self.__strip_postfix(x) for x in scansions}
+        counts = dict.fromkeys(scansions, 0)
+        for entry, count in self.mqdq_frequencies:
+            matches = [x for x in scansions if entry.matches(stripped[x])]
+            if len(matches) < len(scansions):
+                for scansion in matches:
+                    counts[scansion] += count
+        if 0 in counts.values():
+            return {x: counts[x] + 1 for x in counts}
+        return counts
+
     def compare_scansions(self, scansion1, scansion2):
         """
         Compare two ways of scanning a word by calculating how many mqdq entries match the given
-        scansions
+        scansions (see weigh_scansions)
         :param scansion1:
         :param scansion2:
         :return:
         """
-        if (len(self.postfix) != 0) and ("(" not in self.postfix):
-            scansion1 = Scansion(scansion1).pattern[:-1]
-            scansion2 = Scansion(scansion2).pattern[:-1]
-        key = multireplace(self.word, {"v": "u", "j": "i"})
-        mqdq_entries = Word.MQDQ_DICT.look_up(key)
-        s1_count, s2_count = 0, 0
-        for entry in mqdq_entries.keys():
-            mqdq_scansion = WordScansion(entry, True)
-            self.__process(mqdq_scansion, self.next_word_prefix)
-            matches1 = Scansion(mqdq_scansion.scansion).matches(Scansion(scansion1))
-            matches2 = Scansion(mqdq_scansion.scansion).matches(Scansion(scansion2))
-            if matches1 and not matches2:
-                s1_count += sum(mqdq_entries[entry].values())
-            elif not matches1 and matches2:
-                s2_count += sum(mqdq_entries[entry].values())
-        if s1_count + s2_count == 0:
+        if scansion1 == scansion2:
             return 0.5, 0.5
-        if s1_count == 0:
-            s1_count = 1
-            s2_count += 1
-        elif s2_count == 0:
-            s2_count = 1
-            s1_count += 1
-        return s1_count / (s1_count + s2_count), s2_count / (s1_count + s2_count)
+        weights = self.weigh_scansions([scansion1, scansion2])
+        total = weights[scansion1] + weights[scansion2]
+        return weights[scansion1] / total, weights[scansion2] / total
 
     def macronize(self):
         return [Scansion(x.scansion + self.postfix) for x in self.scansions]
@@ -165,21 +270,20 @@ class Word:
         Look up self.word in the dictionaries. Return a set of WordScansion objects
         :return:
         """
-        key = multireplace(self.word, {"v": "u", "j": "i"})
+        key = KEY_NORMALIZER(self.word)
         scansions = {WordScansion(x, False) for x in Word.MORPHEUS_DICT[key]}
         hasMorpheusEntries = len(scansions) != 0
-        mqdq_entry = Word.MQDQ_DICT.look_up(key)
-        for scansion in mqdq_entry.keys():
+        for scansion, total, authors in Word.MQDQ_DICT.look_up_stats(key):
             if sum([Scansion(scansion).matches(Scansion(x.scansion)) for x in scansions]) != 0:
                 continue  # do not consider scansion options that already exist
                 # TODO check how well this works
-            if hasMorpheusEntries and (len(mqdq_entry[scansion].keys()) < Word.AUTHOR_COUNT or sum(
-                    mqdq_entry[scansion].values()) < Word.TOTAL_COUNT or "*" in scansion):
+            if hasMorpheusEntries and (authors < Word.AUTHOR_COUNT or total < Word.TOTAL_COUNT
+                                       or "*" in scansion):
                 continue  # do not consider infrequent scansions
                 # TODO should (or "*" in scansion) be added here
             if not hasMorpheusEntries:
                 # make final syllable unknown
-                scansion = re.sub("[\^_]([^\^_*[\]()]*)$", r"*\1", scansion)
+                scansion = Word.FINAL_SYLLABLE.sub(r"*\1", scansion)
             scansions.add(WordScansion(scansion, True))
         return scansions
 
@@ -188,27 +292,246 @@ class Word:
         if not filename:
             return
         print("Loading MqDq dictionary...")
-        with open(filename, "r") as file:
-            Word.MQDQ_DICT.load(file)
+        if os.path.isdir(filename):  # a directory with a shard for every author
+            Word.MQDQ_DICT.load_shards(filename)
+        else:
+            with open(filename, "r") as file:
+                Word.MQDQ_DICT.load(file)
+        Word.MQDQ_DICT.compact()
+        Word.SOURCES += Word.get_source_files(filename)
+        Word.CACHE.clear()
+
+    @staticmethod
+    def share_lexicons(directory):
+        """
+        Save the Morpheus and MqDq lexicons to files and map them into memory, so that worker
+        processes attach to a single shared copy instead of each receiving their own (see
+        CompactLexicon.attach). The files must be kept until the workers are done and
+        unshare_lexicons() is called
+        :param directory:   the directory to save the files in (e.g. a temporary one)
+        :return:            None
+        """
+        if not isinstance(Word.MQDQ_DICT.data, CompactLexicon):
+            Word.MQDQ_DICT.compact()
+        morpheus_file = os.path.join(directory, "morpheus.lexicon")
+        Word.MORPHEUS_DICT.save(morpheus_file)
+        Word.MORPHEUS_DICT = CompactLexicon.attach(morpheus_file)
+        mqdq_file = os.path.join(directory, "mqdq.lexicon")
+        weights = Word.MQDQ_DICT.data.weights
+        Word.MQDQ_DICT.data.save(mqdq_file)
+        Word.MQDQ_DICT.data = CompactLexicon.attach(mqdq_file)
+        Word.MQDQ_DICT.data.weights = weights
+
+    @staticmethod
+    def unshare_lexicons():
+        """
+        Copy the lexicons shared with share_lexicons() back into memory, so that the files they
+        were shared in can be removed
+        :return:    None
+        """
+        Word.MORPHEUS_DICT.detach()
+        Word.MQDQ_DICT.data.detach()
+
+    @staticmethod
+    def select_authors(authors):
+        """
+        Only use the MqDq data from a subset of authors. This should be called after the
+        dictionaries are loaded but before the persistent cache is opened
+        :param authors: a list of author names, each optionally followed by a colon and a weight
+                        by which the counts of that author are multiplied, e.g. "Ovidius:0.5".
+                        None or an empty list means that all authors are used
+        :return:        None
+        """
+        weights = None
+        if authors:
+            weights = {}
+            for author in authors:
+                name, _, weight = author.partition(":")
+                weights[name] = float(weight) if weight else 1
+        Word.MQDQ_DICT.select_authors(weights)
+        Word.AUTHORS = tuple(sorted(weights.items())) if weights else None
+        Word.CACHE.clear()
+        if weights and not set(weights) & set(Word.MQDQ_DICT.data.authors):
+            warnings.warn("None of the selected authors appear in the MqDq dictionary: "
+                          "{}".format(", ".join(weights)))
 
     @staticmethod
     def load_morpheus_dict(filename):
         print("Loading Morpheus dictionary...")
         with open(filename, "r") as file:
             lines = file.readlines()
+        entries = defaultdict(dict)  # dictionaries are used as ordered sets
+        for key, scansions in Word.MORPHEUS_DICT.items():
+            entries[key] = dict.fromkeys(scansions)
         for line in tqdm(lines):
             key, _, _, scansion = line.rstrip("\n").split("\t")
-            key = multireplace(key.lower(), {"v": "u", "j": "i"})
-            scansion = re.sub("(_\^|\^_)", r"*", scansion)
+            key = KEY_NORMALIZER(key.lower())
+            scansion = Word.ANCEPS.sub(r"*", scansion)
             scansion = Word.__u_to_v(scansion)
             scansion = Word.DIPHTH_REGEX.sub(r"[\1]", scansion)  # marking all diphthongs
             scansion = Word.VOWELS_REGEX.sub(r"\1*", scansion)  # marking all vowels
-            if not DIPHTHONGS:
-                scansion = re.sub("(\[ae\]|\[oe\])", "e_", scansion)
-            Word.MORPHEUS_DICT[key].add(scansion.lower())
+            if not Word.DIPHTHONG:
+                scansion = Word.DIPHTHONG_E.sub("e_", scansion)
+            entries[key][scansion.lower()] = None
+        Word.MORPHEUS_DICT = CompactLexicon(entries, counts=False)
+        Word.SOURCES.append(filename)
+        Word.CACHE.clear()
         # joblib.dump(Word.MORPHEUS_DICT, "../../data/morpheusdict")
         # Word.MORPHEUS_DICT = joblib.load("../../data/morpheusdict")
 
+    @staticmethod
+    def load_dictionaries(mqdq_file, morpheus_file, snapshot_file=None, index_file=None,
+                          forms=None):
+        """
+        Load the MqDq and the Morpheus dictionaries. If a snapshot file is given, the processed
+        dictionaries are loaded from it instead, provided it was built from the same dictionary
+        files. Otherwise the dictionaries are parsed and the snapshot is (re)built. Similarly, if
+        an index file and a set of forms are given, only the entries for these forms are loaded
+        from the index (see Word.save_index)
+        :param mqdq_file:       the name of the MqDq dictionary file (None to not use MqDq)
+        :param morpheus_file:   the name of the Morpheus dictionary file
+        :param snapshot_file:   the name of the snapshot file (None to not use a snapshot)
+        :param index_file:      the name of the index file (None to not use an index)
+        :param forms:           the forms to load from the index (see Word.get_lexicon_keys)
+        :return:                None
+        """
+        sources = [x for x in [mqdq_file, morpheus_file] if x]
+        files = [x for source in sources for x in Word.get_source_files(source)]
+        if snapshot_file or index_file:
+            fingerprint = PersistentCache.fingerprint(files, [Word.SNAPSHOT_VERSION, sources,
+                                                              Word.DIPHTHONG])
+        if index_file and forms is not None and Word.load_index(index_file, fingerprint, forms):
+            Word.SOURCES += files
+            return
+        if snapshot_file and Word.load_snapshot(snapshot_file, fingerprint):
+            Word.SOURCES += files
+        else:
+            Word.load_mqdq_dict(mqdq_file)
+            Word.load_morpheus_dict(morpheus_file)
+            if snapshot_file:
+                Word.save_snapshot(snapshot_file, fingerprint)
+        if index_file:
+            Word.save_index(index_file, fingerprint)
+
+    @staticmethod
+    def get_source_files(filename):
+        """
+        Return the files a dictionary is loaded from
+        :param filename:    a dictionary file or a directory with MqDq shards
+        :return:            a list of filenames
+        """
+        if os.path.isdir(filename):
+            return MqDqDictionary.get_shard_files(filename)
+        return [filename]
+
+    @staticmethod
+    def get_lexicon_keys(word):
+        """
+        Return the keys under which the dictionaries may be queried when a word is analyzed
+        :param word:    a word as returned by Verse.tokenize()
+        :return:        a set of strings
+        """
+        key = KEY_NORMALIZER(word)
+        keys = {key}
+        if word[-3:] in ["que", "qve"]:
+            keys.add(key[:-3])
+        elif word[-2:] in ["ne", "ve", "ue"]:
+            keys.add(key[:-2])
+        return keys
+
+    @staticmethod
+    def save_index(filename, fingerprint):
+        """
+        Save the processed MqDq and Morpheus dictionaries to an SQLite file indexed by form, so
+        that the entries for particular forms can later be loaded without loading everything.
+        Nothing is done if the file is already up to date
+        :param filename:    the name of the index file
+        :param fingerprint: a string that identifies the dictionary files the index is built
+                            from (see PersistentCache.fingerprint)
+        :return:            None
+        """
+        index = PersistentCache(filename, fingerprint)
+        if index.get(["complete"]):
+            index.close()
+            return
+        print("Indexing dictionaries...")
+        for key, scansions in Word.MORPHEUS_DICT.items():
+            index.put(["morpheus", key], scansions)
+        for key, entry in Word.MQDQ_DICT.data.items():
+            index.put(["mqdq", key], entry)
+        index.put(["complete"], True)
+        index.close()
+
+    @staticmethod
+    def load_index(filename, fingerprint, forms):
+        """
+        Load the entries for the given forms from an index file (see Word.save_index)
+        :param filename:    the name of the index file
+        :param fingerprint: the fingerprint the index must have been saved with
+        :param forms:       an iterable of keys as returned by Word.get_lexicon_keys()
+        :return:            True if the entries were loaded, False if the index is missing or
+                            outdated
+        """
+        index = PersistentCache(filename, fingerprint)
+        if not index.get(["complete"]):
+            index.close()
+            return False
+        print("Loading dictionary entries from the index...")
+        morpheus_entries, mqdq_entries = {}, {}
+        for form in sorted(set(forms)):
+            scansions = index.get(["morpheus", form])
+            if scansions is not None:
+                morpheus_entries[form] = scansions
+            entry = index.get(["mqdq", form])
+            if entry is not None:
+                mqdq_entries[form] = entry
+        index.close()
+        Word.MORPHEUS_DICT = CompactLexicon(morpheus_entries, counts=False)
+        Word.MQDQ_DICT.data = CompactLexicon(mqdq_entries)
+        Word.CACHE.clear()
+        return True
+
+    @staticmethod
+    def save_snapshot(filename, fingerprint):
+        """
+        Save the processed MqDq and Morpheus dictionaries to a binary file
+        :param filename:    the name of the snapshot file
+        :param fingerprint: a string that identifies the dictionary files the snapshot is built
+                            from (see PersistentCache.fingerprint)
+        :return:            None
+        """
+        print("Saving dictionary snapshot...")
+        with open(filename, "wb") as file:
+            pickle.dump((Word.SNAPSHOT_VERSION, fingerprint), file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((Word.MORPHEUS_DICT, Word.MQDQ_DICT.data), file,
+                        pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load_snapshot(filename, fingerprint):
+        """
+        Load the processed MqDq and Morpheus dictionaries from a binary file
+        :param filename:    the name of the snapshot file
+        :param fingerprint: the fingerprint the snapshot must have been saved with
+        :return:            True if the snapshot was loaded, False if it is missing or outdated
+        """
+        if not os.path.exists(filename):
+            return False
+        with open(filename, "rb") as file:
+            try:
+                header = pickle.load(file)
+            except (pickle.UnpicklingError, EOFError):
+                header = None
+            if header != (Word.SNAPSHOT_VERSION, fingerprint):
+                warnings.warn("Dictionary snapshot {} is outdated and will be rebuilt".format(
+                    filename))
+                return False
+            print("Loading dictionary snapshot...")
+            morpheus_dict, mqdq_data = pickle.load(file)
+        Word.MORPHEUS_DICT = morpheus_dict
+        Word.MQDQ_DICT.data = mqdq_data
+        Word.CACHE.clear()
+        return True
+
     def __str__(self):
         result = ""
         for scansion in self.scansions:
@@ -236,10 +559,21 @@ class Word:
         # then "u" follows "s", "g", or "q" - it is a consonant (technically, a
         # semivowel, but this is irrelevant for current purposes)
         # SOURCE: Allen and Greenough
-        scansion = re.sub(r'([qg])u([' + VOWELS + '])', r'\1v\2', scansion)
-        scansion = re.sub(r'ue$', r've', scansion)
+        scansion = Word.QU_GU.sub(r'\1v\2', scansion)
+        scansion = Word.FINAL_UE.sub(r've', scansion)
         # u in the beginning of the word followed by a vowel is a consonant.
-        return re.sub(r'(^|[' + VOWELS + '])u([' + VOWELS + '])', r'\1v\2', scansion)
+        return Word.INITIAL_U.sub(r'\1v\2', scansion)
+
+# see Word.__u_to_v()
+Word.QU_GU = re.compile(r'([qg])u([' + VOWELS + '])')
+Word.FINAL_UE = re.compile(r'ue$')
+Word.INITIAL_U = re.compile(r'(^|[' + VOWELS + '])u([' + VOWELS + '])')
+Word.PREFIX_NORMALIZER = Normalizer({"u": "v", "j": "i"})
+
+# used to process dictionary entries
+Word.FINAL_SYLLABLE = re.compile("[\^_]([^\^_*[\]()]*)$")
+Word.ANCEPS = re.compile("(_\^|\^_)")
+Word.DIPHTHONG_E = re.compile("(\[ae\]|\[oe\])")
 
 Word.LONG_BY_POS = re.compile(r"[\^*](" + CLOSE_SYLLABLE + "|[" + CONSONANTS_NOT_H + "]{3})")
 
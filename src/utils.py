@@ -1,4 +1,8 @@
 import re
+import json
+import mmap
+from array import array
+from collections import OrderedDict
 from itertools import product
 
 
@@ -26,20 +30,394 @@ CLOSE_SYLLABLE = '|'.join([''.join(x) for x in product(CONSONANTS, CONSONANTS)
 def multireplace(string, replacements):
     """
     Given a string and a replacement map, it returns the replaced string.
+    Use a Normalizer object instead if the same map is applied repeatedly
     :param str string: string to execute replacements on
     :param dict replacements: replacement dictionary {value to find: value to
     replace}
     :rtype str:
     :original source: Bor González Usach (GitHub snippets)
     """
-    # Place longer ones first to keep shorter substrings from matching where the
-    # longer ones should take place. For instance given the replacements
-    # {'ab': 'AB', 'abc': 'ABC'} against the string 'hey abc', it should produce
-    # 'hey ABC' and not 'hey ABc'
-    substrs = sorted(replacements, key=len, reverse=True)
+    return Normalizer(replacements)(string)
 
-    # Create a big OR regex that matches any of the substrings to replace
-    regexp = re.compile("|".join(map(re.escape, substrs)))
 
-    # For each match, look up the new string in the replacements
-    return regexp.sub(lambda match: replacements[match.group(0)], string)
\ No newline at end of file
+class Normalizer:
+    """
+    Applies a fixed replacement map to strings, exactly like multireplace() does, but compiles the
+    map only once. Maps that only replace single characters are compiled into a str.translate
+    table, other maps into a regex
+    """
+
+    def __init__(self, replacements):
+        """
+        Compile a replacement map
+        :param replacements:    replacement dictionary {value to find: value to replace}
+        """
+        self.replacements = replacements
+        self.table = None
+        self.regex = None
+        if all(len(x) == 1 for x in replacements):
+            self.table = str.maketrans(replacements)
+            return
+        # Place longer ones first to keep shorter substrings from matching where the
+        # longer ones should take place. For instance given the replacements
+        # {'ab': 'AB', 'abc': 'ABC'} against the string 'hey abc', it should produce
+        # 'hey ABC' and not 'hey ABc'
+        substrs = sorted(replacements, key=len, reverse=True)
+        # Create a big OR regex that matches any of the substrings to replace
+        self.regex = re.compile("|".join(map(re.escape, substrs)))
+
+    def __call__(self, string):
+        """
+        Apply the replacements to a string
+        :param string:  string to execute replacements on
+        :return:        the replaced string
+        """
+        if self.table is not None:
+            return string.translate(self.table)
+        # For each match, look up the new string in the replacements
+        return self.regex.sub(lambda match: self.replacements[match.group(0)], string)
+
+
+# normalizes the keys by which word forms and verses are looked up:
+KEY_NORMALIZER = Normalizer({"v": "u", "j": "i"})
+
+
+class LRUCache:
+    """ A cache of limited size that evicts the least recently used entries first """
+
+    def __init__(self, max_size=None):
+        """
+        Initialize a new empty cache
+        :param max_size:    the maximum number of entries to keep. None means unlimited, 0 means
+                            that nothing is cached
+        """
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Look up a key in the cache and mark it as the most recently used one
+        :param key:     the key to look up
+        :param default: value to return if the key is not in the cache
+        :return:        the cached value or default
+        """
+        if key not in self.data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        """
+        Store a value in the cache, evicting the least recently used entries if necessary
+        :param key:     the key to store the value by
+        :param value:   the value to store
+        :return:        None
+        """
+        if self.max_size == 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.max_size is not None and len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all the entries from the cache and reset the counters
+        :return: None
+        """
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Return the number of entries in the cache and the hit/miss counts
+        :return: a dictionary
+        """
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class CompactLexicon:
+    """
+    A read-only dictionary that maps word forms to the ways they can be scanned and, optionally,
+    to the number of times every author scans them that way. All the strings are packed into two
+    long UTF-8 encoded byte strings and all the numbers into arrays, which takes a fraction of the
+    memory that nested dictionaries and sets take. Authors are stored as indices into self.authors.
+    A lexicon can also be saved to a file and attached to by several processes, which then share
+    a single read-only copy of it in memory (see save() and attach())
+    """
+
+    # the buffers that make up a lexicon and are stored in a file by save()
+    STRINGS = ["key_string", "scansion_string"]
+    ARRAYS = ["key_offsets", "entry_offsets", "scansion_offsets", "count_offsets",
+              "author_ids", "author_counts", "totals"]
+
+    def __init__(self, entries=None, counts=True):
+        """
+        Initialize a new lexicon
+        :param entries: a dictionary that maps every form either to a dictionary
+                        {scansion: {author: count}} (if counts is True) or to an iterable of
+                        scansions (if counts is False)
+        :param counts:  whether the lexicon stores author counts
+        """
+        entries = entries or {}
+        self.counts = counts
+        self.filename = None  # the file the lexicon is attached to, if any
+        self.authors = []
+        author_ids = {}
+        keys, scansions = [], []
+        # key i is key_string[key_offsets[i]:key_offsets[i+1]] (the offsets are in bytes)
+        self.key_offsets = array("I", [0])
+        self.entry_offsets = array("I", [0])  # scansions of key i have these indices
+        self.scansion_offsets = array("I", [0])
+        self.count_offsets = array("I", [0])  # counts of scansion i have these indices
+        self.author_ids = array("I")
+        self.author_counts = array("I")
+        self.totals = array("I")  # total count of every scansion
+        self.weights = None  # weight of every author, see select_authors()
+        for key in sorted(entries):
+            keys.append(key.encode("utf-8"))
+            self.key_offsets.append(self.key_offsets[-1] + len(keys[-1]))
+            for scansion in entries[key]:
+                scansions.append(scansion.encode("utf-8"))
+                self.scansion_offsets.append(self.scansion_offsets[-1] + len(scansions[-1]))
+                if not counts:
+                    continue
+                for author, count in entries[key][scansion].items():
+                    if author not in author_ids:
+                        author_ids[author] = len(self.authors)
+                        self.authors.append(author)
+                    self.author_ids.append(author_ids[author])
+                    self.author_counts.append(count)
+                self.count_offsets.append(len(self.author_ids))
+                self.totals.append(sum(entries[key][scansion].values()))
+            self.entry_offsets.append(len(scansions))
+        self.key_string = b"".join(keys)
+        self.scansion_string = b"".join(scansions)
+
+    def save(self, filename):
+        """
+        Save the lexicon to a file that can be mapped into memory with attach()
+        :param filename:    the name of the file
+        :return:            None
+        """
+        buffers = [getattr(self, x) for x in CompactLexicon.STRINGS] + \
+                  [getattr(self, x).tobytes() for x in CompactLexicon.ARRAYS]
+        header = json.dumps({"counts": self.counts, "authors": self.authors,
+                             "sizes": [len(x) for x in buffers]}).encode("utf-8")
+        with open(filename, "wb") as file:
+            file.write(len(header).to_bytes(8, "little"))
+            file.write(header)
+            file.write(bytes(-len(header) % 8))
+            for buffer in buffers:
+                file.write(buffer)
+                file.write(bytes(-len(buffer) % 8))  # keep the arrays aligned
+
+    @staticmethod
+    def attach(filename):
+        """
+        Map a lexicon saved with save() into memory. The file is mapped read-only, so that all the
+        processes that attach to the same file share the memory. Attached lexicons are pickled by
+        reference to the file, i.e. a worker process that receives one attaches to it as well
+        :param filename:    the name of the file
+        :return:            a CompactLexicon object
+        """
+        lexicon = CompactLexicon()
+        lexicon.__attach(filename)
+        return lexicon
+
+    def __attach(self, filename):
+        with open(filename, "rb") as file:
+            self.__mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.__mmap)
+        offset = int.from_bytes(view[:8], "little") + 8
+        header = json.loads(bytes(view[8:offset]).decode("utf-8"))
+        self.filename = filename
+        self.counts = header["counts"]
+        self.authors = header["authors"]
+        offset += -offset % 8
+        for name, size in zip(CompactLexicon.STRINGS + CompactLexicon.ARRAYS, header["sizes"]):
+            buffer = view[offset:offset + size]
+            setattr(self, name, buffer.cast("I") if name in CompactLexicon.ARRAYS else buffer)
+            offset += size + (-size % 8)
+
+    def detach(self):
+        """
+        Copy a lexicon attached with attach() into memory and unmap its file, so that the file
+        can be removed (files that are mapped cannot be removed on Windows)
+        :return:    None
+        """
+        if self.filename is None:
+            return
+        for name in CompactLexicon.STRINGS + CompactLexicon.ARRAYS:
+            buffer = getattr(self, name)
+            if name in CompactLexicon.ARRAYS:
+                setattr(self, name, array("I", buffer.tobytes()))
+            else:
+                setattr(self, name, buffer.tobytes())
+            buffer.release()
+        self.__mmap.close()
+        self.__mmap = None
+        self.filename = None
+
+    def get(self, key, default=None):
+        """
+        Look up a form in the lexicon
+        :param key:     the form to look up
+        :param default: value to return if the form is not in the lexicon
+        :return:        a dictionary {scansion: {author: count}} if the lexicon stores counts,
+                        a set of scansions otherwise
+        """
+        i = self.__find(key)
+        if i is None:
+            return default
+        entry = self.__get_entry(i)
+        if not entry:  # no selected author uses the form
+            return default
+        return entry if self.counts else set(entry)
+
+    def get_stats(self, key):
+        """
+        Look up the statistics for a form in a lexicon that stores counts. These are precomputed
+        unless a subset of authors is selected (see select_authors)
+        :param key: the form to look up
+        :return:    a list of (scansion, total count, number of authors) tuples, which is empty
+                    if the form is not in the lexicon
+        """
+        i = self.__find(key)
+        if i is None:
+            return []
+        result = []
+        for j in range(self.entry_offsets[i], self.entry_offsets[i + 1]):
+            if self.weights is None:
+                total, authors = self.totals[j], self.count_offsets[j + 1] - self.count_offsets[j]
+            else:
+                total, authors = 0, 0
+                for k in range(self.count_offsets[j], self.count_offsets[j + 1]):
+                    weight = self.weights[self.author_ids[k]]
+                    if weight:
+                        total += weight * self.author_counts[k]
+                        authors += 1
+                if authors == 0:
+                    continue
+            result.append((self.__scansion(j), total, authors))
+        return result
+
+    def select_authors(self, weights):
+        """
+        Make the lexicon behave as if it was built from the works of a subset of authors only. The
+        counts of the selected authors are multiplied by their weights and the counts of all other
+        authors are ignored. Scansions (and forms) that no selected author uses are skipped
+        :param weights: a dictionary {author: weight} or None to use all authors
+        :return:        None
+        """
+        if weights is None:
+            self.weights = None
+        else:
+            self.weights = [weights.get(author, 0) for author in self.authors]
+
+    def keys(self):
+        return (self.__key(i) for i in range(len(self)))
+
+    def items(self):
+        """
+        Iterate over all the entries in the lexicon. Unlike get(), this returns the scansions of a
+        lexicon without counts as a list, so that the order in which they were given is preserved
+        :return: a generator of (form, entry) pairs
+        """
+        for i in range(len(self)):
+            entry = self.__get_entry(i)
+            if entry:
+                yield self.__key(i), entry if self.counts else list(entry)
+
+    def to_dict(self):
+        """
+        Convert the lexicon back into nested dictionaries (or lists of scansions)
+        :return: a dictionary
+        """
+        return dict(self.items())
+
+    def __get_entry(self, i):
+        """
+        Unpack the entry with the given index
+        :param i:   an integer
+        :return:    a dictionary that maps scansions to dictionaries {author: count} (or to None,
+                    if the lexicon stores no counts) in the order they were given in. Only the
+                    selected authors are included (see select_authors)
+        """
+        result = {}
+        for j in range(self.entry_offsets[i], self.entry_offsets[i + 1]):
+            scansion = self.__scansion(j)
+            if not self.counts:
+                result[scansion] = None
+                continue
+            counts = {}
+            for k in range(self.count_offsets[j], self.count_offsets[j + 1]):
+                author, count = self.author_ids[k], self.author_counts[k]
+                if self.weights is not None:
+                    if not self.weights[author]:
+                        continue
+                    count *= self.weights[author]
+                counts[self.authors[author]] = count
+            if counts or self.weights is None:
+                result[scansion] = counts
+        return result
+
+    def __key(self, i):
+        return self.__key_bytes(i).decode("utf-8")
+
+    def __key_bytes(self, i):
+        return bytes(self.key_string[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    def __scansion(self, j):
+        return bytes(self.scansion_string[self.scansion_offsets[j]:
+                                          self.scansion_offsets[j + 1]]).decode("utf-8")
+
+    def __find(self, key):
+        """
+        Find the index of a key by binary search
+        :param key: a string
+        :return:    an integer or None if there is no such key
+        """
+        key = key.encode("utf-8")  # UTF-8 preserves the order of the strings
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__key_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.__key_bytes(low) == key:
+            return low
+        return None
+
+    def __getstate__(self):
+        if self.filename is not None:  # attach to the same file instead of copying the buffers
+            return {"filename": self.filename, "weights": self.weights}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "key_string" not in state:
+            self.__attach(state["filename"])
+            self.weights = state["weights"]
+        else:
+            self.__dict__.update(state)
+
+    def __getitem__(self, key):
+        return self.get(key, {} if self.counts else set())
+
+    def __contains__(self, key):
+        return self.__find(key) is not None
+
+    def __len__(self):
+        return len(self.key_offsets) - 1